@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Cross-checks Doppelganger.lib symbol pins against Doppelganger.pretty
+footprint pads, using the cached symbol and footprint indexes"""
+
+import os
+import re
+import ast
+import sys
+import argparse
+
+import fp_index
+from sym_index import SymbolIndex
+
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+
+def pin_sort_key(pin):
+    """Natural sort key of a pin/pad name (2 before 10)"""
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part)
+            for part in re.split(r"(\d+)", pin)]
+
+
+def _get_class_pairs(tree, base="ICHelper"):
+    """Returns the (SYMBOL, MODULE) of the classes deriving (at any depth)
+    from base in a module syntax tree"""
+    classes = {node.name: node for node in tree.body
+               if isinstance(node, ast.ClassDef)}
+    derived = {base}
+    pairs = []
+    changed = True
+    while changed:
+        changed = False
+        for name, node in classes.items():
+            if name in derived or \
+                    not any(getattr(b, "id", None) in derived
+                            for b in node.bases):
+                continue
+            derived.add(name)
+            changed = True
+            attrs = {}
+            for item in node.body:
+                if isinstance(item, ast.Assign):
+                    for target in item.targets:
+                        if getattr(target, "id", None) in ("SYMBOL",
+                                                           "MODULE"):
+                            attrs[target.id] = ast.literal_eval(item.value)
+            if attrs.get("SYMBOL") is not None:
+                pairs.append((attrs["SYMBOL"], attrs.get("MODULE")))
+    return pairs
+
+
+def get_sch_utils_pairs(sch_utils_path=None):
+    """Returns the symbol/footprint pairs of sch_utils: its DOP_KNOWN_PAIRS
+    and the chips of its ICHelper subclasses. The source is read (not
+    imported) so neither skidl nor its libraries are needed."""
+    if sch_utils_path is None:
+        sch_utils_path = os.path.join(HERE, "sch_utils.py")
+    with open(sch_utils_path) as sch_file:
+        tree = ast.parse(sch_file.read(), sch_utils_path)
+    pairs = []
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and \
+                any(getattr(target, "id", None) == "DOP_KNOWN_PAIRS"
+                    for target in node.targets):
+            pairs += [tuple(pair) for pair in ast.literal_eval(node.value)]
+    return pairs + _get_class_pairs(tree)
+
+
+def check_pair(symbol, footprint, sym_idx, fp_idx):
+    """Checks a symbol/footprint pair.
+    Returns (errors, warnings) as lists of messages. Pins without a pad are
+    errors; named pads without a pin are only warnings (mounting pads...)."""
+    name = "{0}/{1}".format(symbol, footprint)
+    if symbol not in sym_idx:
+        return ["{0}: unknown symbol {1}".format(name, symbol)], []
+    entry = fp_idx.get(footprint)
+    if entry is None:
+        return ["{0}: unknown footprint {1}".format(name, footprint)], []
+    if "error" in entry:
+        return ["{0}: malformed footprint ({1})".format(name,
+                                                        entry["error"])], []
+
+    pins = sym_idx.pin_numbers(symbol)
+    pads = fp_idx.pad_names(footprint) - {""}
+    errors, warnings = [], []
+    missing_pads = sorted(pins - pads, key=pin_sort_key)
+    if missing_pads:
+        errors.append("{0}: pins without pad: {1}".format(
+            name, ", ".join(missing_pads)))
+    unused_pads = sorted(pads - pins, key=pin_sort_key)
+    if unused_pads:
+        warnings.append("{0}: pads without pin: {1}".format(
+            name, ", ".join(unused_pads)))
+    return errors, warnings
+
+
+def check_pairs(pairs, sym_idx, fp_idx):
+    """Checks all the given pairs. Returns (errors, warnings)"""
+    errors, warnings = [], []
+    for symbol, footprint in sorted(set(pairs)):
+        pair_errors, pair_warnings = check_pair(symbol, footprint, sym_idx,
+                                                fp_idx)
+        errors += pair_errors
+        warnings += pair_warnings
+    return errors, warnings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Symbol/footprint cross-checker")
+    parser.add_argument("--lib",
+                        default=os.path.join(HERE, "Doppelganger.lib"),
+                        help="legacy schematic library")
+    parser.add_argument("--pretty",
+                        default=os.path.join(HERE, "Doppelganger.pretty"),
+                        help="footprint library")
+    parser.add_argument("pairs", nargs="*", metavar="SYMBOL:FOOTPRINT",
+                        help="extra pairs to check (the sch_utils ones are "
+                             "always checked)")
+    args = parser.parse_args()
+
+    all_pairs = get_sch_utils_pairs()
+    for pair in args.pairs:
+        all_pairs.append(tuple(pair.split(":", 1)))
+
+    all_errors, all_warnings = check_pairs(all_pairs,
+                                           SymbolIndex.load(args.lib),
+                                           fp_index.get_index(args.pretty))
+    for message in all_warnings:
+        print("Warning: " + message)
+    for message in all_errors:
+        print("Error: " + message)
+    print("{0} pairs checked, {1} errors, {2} warnings".format(
+        len(set(all_pairs)), len(all_errors), len(all_warnings)))
+    sys.exit(1 if all_errors else 0)
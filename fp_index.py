@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Footprint library (.pretty) indexer.
+Every .kicad_mod file is parsed (in parallel worker processes) and its pad
+names, layers, bounding box and 3D models are stored in a compact json
+index that can be queried without pcbnew."""
+
+import os
+import sys
+import json
+import math
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import sexpr
+
+
+INDEX_VERSION = 1
+INDEX_NAME = ".fp_index.json"
+FP_EXTENSION = ".kicad_mod"
+
+
+def _xy(node, key):
+    """Returns the (x, y) of the (key x y ...) child of a node, or None"""
+    for item in node[1:]:
+        if isinstance(item, list) and item and item[0] == key:
+            return float(item[1]), float(item[2])
+    return None
+
+
+def _children(node, key):
+    """Returns the children of a node having the given head"""
+    return [item for item in node[1:]
+            if isinstance(item, list) and item and item[0] == key]
+
+
+class _BBox():
+    """Just a growing bounding box"""
+
+    def __init__(self):
+        """Just init the brand new (empty) instance"""
+        self.bounds = None
+
+    def add(self, x, y, margin=0.0):
+        """Extends the box to the given point (plus margin)"""
+        if self.bounds is None:
+            self.bounds = [x - margin, y - margin, x + margin, y + margin]
+            return
+        self.bounds = [min(self.bounds[0], x - margin),
+                       min(self.bounds[1], y - margin),
+                       max(self.bounds[2], x + margin),
+                       max(self.bounds[3], y + margin)]
+
+    def add_rect(self, x, y, half_w, half_h):
+        """Extends the box to a centered rectangle"""
+        self.add(x - half_w, y - half_h)
+        self.add(x + half_w, y + half_h)
+
+
+def _pad_extent(pad):
+    """Returns the (half width, half height) of a pad, rotation included"""
+    size = _xy(pad, "size") or (0.0, 0.0)
+    at = _children(pad, "at")
+    rotation = float(at[0][3]) if at and len(at[0]) > 3 else 0.0
+    if rotation % 180 == 0:
+        return size[0] / 2, size[1] / 2
+    if rotation % 90 == 0:
+        return size[1] / 2, size[0] / 2
+    radius = math.hypot(*size) / 2
+    return radius, radius
+
+
+def parse_footprint(stream):
+    """Parses a footprint stream. Returns its index entry"""
+    module = sexpr.load(stream, strict=True)
+    if not module or module[0] not in ("module", "footprint"):
+        raise ValueError("Not a footprint")
+
+    pads = []
+    pad_count = 0
+    layers = set()
+    models = []
+    bbox = _BBox()
+    for item in module[2:]:
+        if not isinstance(item, list) or not item:
+            continue
+        head = item[0]
+        for layer in _children(item, "layer") + _children(item, "layers"):
+            layers.update(layer[1:])
+        if head == "layer":
+            layers.update(item[1:])
+        elif head == "pad":
+            pad_count += 1
+            if item[1] not in pads:
+                pads.append(item[1])
+            center = _xy(item, "at")
+            if center is not None:
+                bbox.add_rect(center[0], center[1], *_pad_extent(item))
+        elif head in ("fp_line", "fp_rect"):
+            for key in ("start", "end"):
+                point = _xy(item, key)
+                if point is not None:
+                    bbox.add(*point)
+        elif head in ("fp_circle", "fp_arc"):
+            center, end = _xy(item, "center") or _xy(item, "start"), \
+                _xy(item, "end")
+            if center is not None and end is not None:
+                radius = math.hypot(end[0] - center[0], end[1] - center[1])
+                bbox.add(center[0], center[1], radius)
+        elif head == "fp_poly":
+            for pts in _children(item, "pts"):
+                for point in _children(pts, "xy"):
+                    bbox.add(float(point[1]), float(point[2]))
+        elif head == "model":
+            models.append(item[1])
+
+    return {"name": module[1],
+            "pads": pads,
+            "pad_count": pad_count,
+            "layers": sorted(layers),
+            "bbox": bbox.bounds,
+            "models": models}
+
+
+def index_footprint_file(path):
+    """Indexes a single .kicad_mod file. Malformed footprints get an entry
+    with an error message instead of raising."""
+    mtime = os.stat(path).st_mtime_ns
+    try:
+        with open(path, encoding="utf-8") as fp_file:
+            entry = parse_footprint(fp_file)
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        entry = {"error": "{0}: {1}".format(type(e).__name__, e)}
+    entry["mtime"] = mtime
+    return entry
+
+
+def get_user_cache_dir():
+    """Returns the user cache directory of the tools"""
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_dir, "kinet2pcb")
+
+
+def get_index_path(lib_dir):
+    """Returns the default index path of a footprint library"""
+    return os.path.join(lib_dir, INDEX_NAME)
+
+
+def get_cache_index_path(lib_dir):
+    """Returns the index path of a footprint library in the user cache
+    directory, used when the library is read only (e.g. system libraries)"""
+    lib_hash = hashlib.sha1(os.path.realpath(lib_dir).encode()).hexdigest()
+    return os.path.join(get_user_cache_dir(), "fp_index",
+                        lib_hash[:16] + ".json")
+
+
+class FootprintIndex():
+    """Index of a footprint library"""
+
+    def __init__(self, library, footprints=None):
+        """Just init the brand new instance"""
+        self.library = library
+        self.footprints = {} if footprints is None else footprints
+
+    def __contains__(self, name):
+        return name in self.footprints
+
+    def __len__(self):
+        return len(self.footprints)
+
+    def get(self, name):
+        """Returns the index entry of a footprint (None if unknown)"""
+        return self.footprints.get(name)
+
+    def pad_names(self, name):
+        """Returns the set of the pad names of a footprint"""
+        return set(self.footprints[name].get("pads", []))
+
+    def errors(self):
+        """Returns the {footprint name: error} of malformed footprints"""
+        return {name: entry["error"]
+                for name, entry in self.footprints.items()
+                if "error" in entry}
+
+    def as_dict(self):
+        """Returns the index as a json friendly dict"""
+        return {"version": INDEX_VERSION, "library": self.library,
+                "footprints": self.footprints}
+
+    def save(self, path=None):
+        """Saves the (compact) index"""
+        if path is None:
+            path = get_index_path(self.library)
+        with open(path, "w") as index_file:
+            json.dump(self.as_dict(), index_file, separators=(",", ":"),
+                      sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index. Returns None if missing or outdated"""
+        try:
+            with open(path) as index_file:
+                data = json.load(index_file)
+        except (IOError, ValueError):
+            return None
+        if data.get("version") != INDEX_VERSION:
+            return None
+        return cls(data["library"], data["footprints"])
+
+
+def build_index(lib_dir, previous=None, jobs=None):
+    """Indexes all the footprints of a library in parallel. Entries of a
+    previous index are reused for the files that did not change."""
+    footprints = {}
+    todo = []
+    for file_name in sorted(os.listdir(lib_dir)):
+        if not file_name.endswith(FP_EXTENSION):
+            continue
+        name = file_name[:-len(FP_EXTENSION)]
+        path = os.path.join(lib_dir, file_name)
+        entry = previous.get(name) if previous is not None else None
+        if entry is not None and entry["mtime"] == os.stat(path).st_mtime_ns:
+            footprints[name] = entry
+        else:
+            todo.append((name, path))
+
+    if jobs == 1 or len(todo) < 2:
+        entries = [index_footprint_file(path) for _, path in todo]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            entries = list(executor.map(index_footprint_file,
+                                        [path for _, path in todo],
+                                        chunksize=8))
+    for (name, _), entry in zip(todo, entries):
+        footprints[name] = entry
+    return FootprintIndex(os.path.realpath(lib_dir), footprints)
+
+
+def get_index(lib_dir, jobs=None, index_path=None):
+    """Returns the up to date index of a library: the saved index is
+    refreshed (and saved back, if possible) when some footprints changed.
+    Without index_path, the index is kept in the library, or in the user
+    cache directory if the library is not writable."""
+    if index_path is None:
+        index_paths = [get_index_path(lib_dir), get_cache_index_path(lib_dir)]
+    else:
+        index_paths = [index_path]
+    previous = None
+    for path in index_paths:
+        previous = FootprintIndex.load(path)
+        if previous is not None:
+            break
+    index = build_index(lib_dir, previous, jobs)
+    if previous is None or previous.footprints != index.footprints:
+        for path in index_paths:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                index.save(path)
+                break
+            except (IOError, OSError):
+                pass
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Footprint library indexer")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument("-o", default=None,
+                        help="index file (default: <library>/" + INDEX_NAME
+                             + ", or the user cache if the library is read "
+                               "only; only with a single library)")
+    parser.add_argument("libraries", nargs="+", help=".pretty directories")
+    args = parser.parse_args()
+    if args.o is not None and len(args.libraries) > 1:
+        parser.error("-o needs a single library")
+
+    has_errors = False
+    for library in args.libraries:
+        lib_index = get_index(library, args.jobs, args.o)
+        print("{0}: {1} footprints".format(library, len(lib_index)))
+        for fp_name, error in sorted(lib_index.errors().items()):
+            print("\t{0}: {1}".format(fp_name, error))
+            has_errors = True
+    sys.exit(1 if has_errors else 0)
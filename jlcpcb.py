@@ -1,116 +1,515 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import sys
 import csv
+import json
+import hashlib
+import time
 import argparse
+import operator
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+import sexpr
+from profiling import Profile, add_profile_argument, dump_json
 
 
 class Component():
-    """Just an abstract of a PCB component"""
+    """Just an abstract of a PCB component (fixed schema record)"""
+
+    __slots__ = ("designator", "ref", "jlcpcb_cc", "jlcpcb_rotation_offset",
+                 "val", "package", "position_x", "position_y", "rotation",
+                 "pcb_side")
+    OPTIONAL_ATTRS = ("val", "package", "position_x", "position_y",
+                      "rotation", "pcb_side")
 
-    def __init__(self, designator):
+    def __init__(self, designator, ref=None, jlcpcb_cc=None,
+                 jlcpcb_rotation_offset=0):
         """Just init the brand new instance"""
         self.designator = designator
+        self.ref = ref
+        self.jlcpcb_cc = jlcpcb_cc
+        self.jlcpcb_rotation_offset = jlcpcb_rotation_offset
+        self.val = self.package = self.pcb_side = None
+        self.position_x = self.position_y = self.rotation = None
 
     def __str__(self):
         """Just export the component in a readable form"""
-        ret = self.designator + "\n"
-        ret += "\tRef: {0}\n".format(self.ref)
-        ret += "\tJLCPCB_CC: {0}\n".format(self.jlcpcb_cc)
-        attrs = ("val", "package", "position_x", "position_y", "rotation",
-                 "pcb_side")
-        for attr in attrs:
-            if hasattr(self, attr):
-                ret += "\t {0}: {1}\n".format(attr, getattr(self, attr))
-
-        return ret
+        lines = [str(self.designator),
+                 "\tRef: {0}".format(self.ref),
+                 "\tJLCPCB_CC: {0}".format(self.jlcpcb_cc)]
+        for attr in self.OPTIONAL_ATTRS:
+            value = getattr(self, attr)
+            if value is not None:
+                lines.append("\t {0}: {1}".format(attr, value))
+        return "\n".join(lines) + "\n"
 
     def __repr__(self):
         return str(self)
 
 
-def get_components_from_xml(xml_path):
-    components = []
-    inside_component = False
-    current_component = None
-    for line in open(xml_path).readlines():
-        line = line.strip()
-        if not inside_component:
-            if "<comp ref" in line:
-                inside_component = True
-                designator = line.split('"')[1]
-                current_component = Component(designator)
+class Board():
+    """Array of components of a whole board, indexed by designator"""
+
+    __slots__ = ("components", "index")
+
+    def __init__(self, components=()):
+        """Just init the brand new instance"""
+        self.components = []
+        self.index = {}
+        for component in components:
+            self.append(component)
+
+    def append(self, component):
+        """Adds a component to the board"""
+        self.index[component.designator] = len(self.components)
+        self.components.append(component)
+
+    def get(self, designator, default=None):
+        """Returns the component of the given designator"""
+        row = self.index.get(designator)
+        if row is None:
+            return default
+        return self.components[row]
+
+    def __iter__(self):
+        return iter(self.components)
+
+    def __len__(self):
+        return len(self.components)
+
+    def __getitem__(self, row):
+        return self.components[row]
+
+
+def _set_field(component, name, value):
+    """Stores a netlist field into the component, if relevant"""
+    if name in ("F1", "Ref"):
+        # Ref is (hopefully) the same than F1
+        component.ref = value
+    elif name == "JLCC":
+        component.jlcpcb_cc = value
+    elif name == "JLROT":
+        component.jlcpcb_rotation_offset = float(value)
+
+
+def _field_from_node(node):
+    """Returns (name, value) from a parsed (field (name ...) ...) node"""
+    name = None
+    values = []
+    for item in node[1:]:
+        if isinstance(item, list):
+            if len(item) > 1 and item[0] == "name":
+                name = item[1]
         else:
-            if "</comp>" in line:
-                if not hasattr(current_component, "jlcpcb_rotation_offset"):
-                    current_component.jlcpcb_rotation_offset = 0
-                if hasattr(current_component, "jlcpcb_cc"):
-                    components.append(current_component)
-                inside_component = False
-            elif "field (name F1)" in line:
-                current_component.ref = line.split()[-1][:-1]
-            elif "field (name Ref)" in line:
-                # Same (hopefully) than F1
-                current_component.ref = line.split()[-1][:-1]
-            elif "field (name JLCC)" in line:
-                current_component.jlcpcb_cc = line.split()[-1][:-1]
-            elif "field (name JLROT)" in line:
-                offset = float(line.split()[-1][:-1])
-                current_component.jlcpcb_rotation_offset = offset
-    return components
+            values.append(item)
+    return name, " ".join(values)
+
+
+def _join_text(tokens):
+    """Joins the tokens of an xml text, without spaces inside parenthesis"""
+    return re.sub(r"\( | \)", lambda match: match.group().strip(),
+                  " ".join(tokens))
+
+
+def iter_components_from_xml(xml_path):
+    """Lazily yields the JLCPCB components (the ones with a JLCC field) of a
+    netlist. The file is streamed, so memory stays flat whatever its size."""
+    component = None
+    xml_field = None
+    xml_text = []
+    stack = []
+    with open(xml_path, buffering=sexpr.CHUNK_SIZE) as xml_file:
+        for token in sexpr.iter_tokens(xml_file, xml=True):
+            if xml_field is not None and token[0] != "<":
+                # Parenthesis of an xml field text are just text
+                xml_text.append(token)
+            elif token == "(":
+                stack.append([])
+            elif token == ")":
+                if not stack:
+                    continue
+                node = stack.pop()
+                head = node[0] if node else None
+                parent = stack[-1][0] if stack and stack[-1] else None
+                if head == "field" and component is not None:
+                    _set_field(component, *_field_from_node(node))
+                elif head == "ref" and parent == "comp" and len(node) > 1:
+                    component.designator = node[1]
+                elif head == "comp" and component is not None:
+                    if _is_jlcpcb_component(component):
+                        yield component
+                    component = None
+                elif parent == "field":
+                    stack[-1].append(node)
+            elif token[0] == "<":
+                if token.startswith("<comp "):
+                    designator = re.search(r'ref="([^"]*)"', token).group(1)
+                    component = Component(designator)
+                elif token.startswith("</comp") and component is not None:
+                    if _is_jlcpcb_component(component):
+                        yield component
+                    component = None
+                elif token.startswith("<field ") and component is not None:
+                    xml_field = re.search(r'name="([^"]*)"', token).group(1)
+                    xml_text = []
+                elif token.startswith("</field") and xml_field is not None:
+                    _set_field(component, xml_field, _join_text(xml_text))
+                    xml_field = None
+            elif stack:
+                stack[-1].append(sexpr.unquote(token))
+                if len(stack) > 1 and stack[-1] == ["comp"]:
+                    component = Component(None)
+
+
+def _is_jlcpcb_component(component):
+    """Returns True if the component has to be assembled by JLCPCB"""
+    return bool(component.jlcpcb_cc)
+
+
+def get_components_from_xml(xml_path):
+    """Returns the list of the JLCPCB components of a netlist"""
+    return list(iter_components_from_xml(xml_path))
+
+
+class BoardPositions():
+    """Columnar view of a kicad pos file"""
+
+    SIDES = ("top", "bottom")
+
+    def __init__(self):
+        """Just init the brand new (empty) instance"""
+        self.index = {}
+        self.values = []
+        self.packages = []
+        self.position_x = array("d")
+        self.position_y = array("d")
+        self.rotation = array("d")
+        self.side = array("B")
+        self.skipped = set()
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, designator, val, package, pos_x, pos_y, rot, side):
+        """Adds a new row"""
+        self.index[designator] = len(self.values)
+        self.values.append(val)
+        self.packages.append(package)
+        self.position_x.append(float(pos_x))
+        self.position_y.append(float(pos_y))
+        self.rotation.append(float(rot))
+        self.side.append(self.SIDES.index(side))
 
 
 def parse_board_pos(pos_content, sides):
-    """Just parse the pos content"""
-    kicad_positions = csv.reader(pos_content)
-    return {els[0]: els[1:] for els in kicad_positions
-            if els[0] != "Ref"
-            if els[-1] in sides}
+    """Parses the pos content into typed columns. Rows of other sides are
+    only remembered as skipped."""
+    positions = BoardPositions()
+    for els in csv.reader(pos_content):
+        if not els or els[0] == "Ref":
+            continue
+        if els[-1] in sides:
+            positions.append(*els)
+        else:
+            positions.skipped.add(els[0])
+    return positions
+
+
+def join_positions(components, positions):
+    """Joins the positions to the components by designator, in one pass.
+    Returns the placed components (as a Board) and the designators with no
+    position. Components on a skipped side are silently dropped."""
+    placed = Board()
+    missing = []
+    rows = array("l")
+    index = positions.index
+    for component in components:
+        row = index.get(component.designator)
+        if row is not None:
+            placed.append(component)
+            rows.append(row)
+        elif component.designator not in positions.skipped:
+            missing.append(component.designator)
+
+    sides = BoardPositions.SIDES
+    for component, row in zip(placed, rows):
+        (component.val, component.package, component.position_x,
+         component.position_y, component.rotation, component.pcb_side) = (
+             positions.values[row], positions.packages[row],
+             positions.position_x[row], positions.position_y[row],
+             positions.rotation[row], sides[positions.side[row]])
+    return placed, missing
+
+
+def get_cpl_rotations(components):
+    """Returns the CPL rotations (board rotation plus JLCPCB offset)"""
+    return array("d", map(operator.add,
+                          array("d", [c.rotation for c in components]),
+                          array("d", [c.jlcpcb_rotation_offset
+                                      for c in components])))
+
+
+CPL_HEADER = ["Designator", "Mid X", "Mid Y", "Layer", "Rotation"]
+BOM_HEADER = ["Designator", "Comment", "Footprint", "LCSC part#"]
+CACHE_VERSION = 1
+
+
+def get_cpl_rows(components):
+    """Returns the JLCPCB CPL rows (header excluded)"""
+    rotations = get_cpl_rotations(components)
+    return [[component.designator,
+             "{0:.4f}".format(component.position_x),
+             "{0:.4f}".format(component.position_y),
+             component.pcb_side, rotation]
+            for component, rotation in zip(components, rotations)]
+
+
+def write_csv(csv_path, header, rows):
+    """Writes a JLCPCB csv file"""
+    with open(csv_path, "w", newline="") as csvfile:
+        csv_writer = csv.writer(csvfile, delimiter=",")
+        csv_writer.writerow(header)
+        csv_writer.writerows(rows)
+
+
+def get_cpl_path(out_dir, project_name):
+    """Returns the path of the CPL file"""
+    return os.path.join(out_dir, project_name + "_CPL_" + ".csv")
+
+
+def get_bom_path(out_dir, project_name):
+    """Returns the path of the BOM file"""
+    return os.path.join(out_dir, project_name + "_BOM_" + ".csv")
 
 
 def create_cpl(components, out_dir, project_name):
     """Generates the JLCPCB CPL file"""
-    csv_path = os.path.join(out_dir, project_name + "_CPL_" + ".csv")
-    with open(csv_path, "w", newline='') as csvfile:
-        header = ["Designator", "Mid X", "Mid Y", "Layer", "Rotation"]
-        cpl_writer = csv.writer(csvfile, delimiter=",")
-        cpl_writer.writerow(header)
-        for component in components:
-            cpl_writer.writerow([component.designator,
-                                 component.position_x, component.position_y,
-                                 component.pcb_side,
-                                 float(component.rotation) +\
-                                 component.jlcpcb_rotation_offset])
+    write_csv(get_cpl_path(out_dir, project_name), CPL_HEADER,
+              get_cpl_rows(components))
+
+def designator_sort_key(designator):
+    """Natural sort key of a designator (R2 before R10)"""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r"(\d+)", designator)]
+
+
+def group_components(components):
+    """Groups components by (value, package, LCSC part#) in a single pass.
+    Returns the list of (key, designators) with designators naturally sorted
+    and groups sorted by their first designator."""
+    groups = {}
+    for component in components:
+        key = (component.val, component.package, component.jlcpcb_cc)
+        groups.setdefault(key, []).append(component.designator)
+    for designators in groups.values():
+        designators.sort(key=designator_sort_key)
+    return sorted(groups.items(),
+                  key=lambda group: designator_sort_key(group[1][0]))
+
+
+def get_bom_header(grouped=False):
+    """Returns the JLCPCB BOM header"""
+    if grouped:
+        return BOM_HEADER + ["Quantity"]
+    return BOM_HEADER
 
-def create_bom(components, out_dir, project_name):
+
+def get_bom_rows(components, grouped=False):
+    """Returns the JLCPCB BOM rows (header excluded). If grouped is True,
+    components sharing the same value, package and LCSC part# are merged in
+    a single row."""
+    if grouped:
+        return [[",".join(designators), val, package, jlcpcb_cc,
+                 len(designators)]
+                for (val, package, jlcpcb_cc), designators
+                in group_components(components)]
+    return [[component.designator, component.val, component.package,
+             component.jlcpcb_cc]
+            for component in components]
+
+
+def create_bom(components, out_dir, project_name, grouped=False):
     """Generates the JLCPCB BOM file"""
-    csv_path = os.path.join(out_dir, project_name + "_BOM_" + ".csv")
-    header = ["Designator", "Comment", "Footprint", "LCSC part#"]
-    with open(csv_path, "w", newline="") as csvfile:
-        bom_writer = csv.writer(csvfile, delimiter=",")
-        bom_writer.writerow(header)
-        for component in components:
-            bom_writer.writerow([component.designator,
-                                 component.val,
-                                 component.package,
-                                 component.jlcpcb_cc])
+    write_csv(get_bom_path(out_dir, project_name), get_bom_header(grouped),
+              get_bom_rows(components, grouped))
+
+
+def _file_digest(path):
+    """Returns the sha256 of a file, read chunk by chunk"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(sexpr.CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _row_digest(row):
+    """Returns a short digest of a csv row"""
+    return hashlib.sha1("\x1f".join(map(str, row)).encode()).hexdigest()
+
+
+def get_build_fingerprint(xml_path, pos_content, sides, grouped):
+    """Fingerprints the inputs and options of a build"""
+    digest = hashlib.sha256()
+    digest.update(_file_digest(xml_path).encode())
+    digest.update(pos_content.encode())
+    digest.update(json.dumps([CACHE_VERSION, sorted(sides),
+                              grouped]).encode())
+    return digest.hexdigest()
 
-def jlcpcb_build(xml_path, pos_file, project_name, out_dir, sides=None):
-    """Generates JLCPCB BOM and CPL"""
+
+def get_cache_path(out_dir, project_name):
+    """Returns the path of the build cache of a project"""
+    return os.path.join(out_dir, project_name + "_jlcpcb_cache.json")
+
+
+def load_build_cache(cache_path):
+    """Loads a build cache. Returns an empty one if missing or unreadable"""
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache
+
+
+def save_build_cache(cache_path, cache):
+    """Saves a build cache"""
+    cache["version"] = CACHE_VERSION
+    with open(cache_path, "w") as cache_file:
+        json.dump(cache, cache_file)
+
+
+def update_csv(csv_path, header, rows, cached):
+    """Writes a csv file only if some of its rows changed since the cached
+    build. Returns (cache entry, written)."""
+    digests = {str(row[0]): _row_digest(row) for row in rows}
+    entry = {"header": header, "rows": digests,
+             "order": [str(row[0]) for row in rows]}
+    if cached is not None and cached == entry and os.path.isfile(csv_path):
+        return entry, False
+    write_csv(csv_path, header, rows)
+    return entry, True
+
+
+def jlcpcb_build(xml_path, pos_file, project_name, out_dir, sides=None,
+                 grouped=False, use_cache=True, profile=None):
+    """Generates JLCPCB BOM and CPL.
+    With use_cache, nothing is done if the inputs and options did not change
+    since the last build, and only the outputs with changed rows are
+    rewritten. Returns the list of written files.
+    If given, profile records the phase timings and counters."""
     if sides is None:
         sides = ["top", "bottom"]
-    components = get_components_from_xml(xml_path)
-    positions = parse_board_pos(pos_file, sides)
-    for component in components:
-        attrs = ("val", "package", "position_x", "position_y", "rotation",
-                 "pcb_side")
-        for i, val in enumerate(positions[component.designator]):
-            setattr(component, attrs[i], val)
+    if profile is None:
+        profile = Profile("jlcpcb")
+    cache_path = get_cache_path(out_dir, project_name)
+    cpl_path = get_cpl_path(out_dir, project_name)
+    bom_path = get_bom_path(out_dir, project_name)
+    with profile.phase("fingerprint"):
+        pos_content = pos_file.read()
+        fingerprint = get_build_fingerprint(xml_path, pos_content, sides,
+                                            grouped)
+        cache = load_build_cache(cache_path) if use_cache else {}
+    if cache.get("fingerprint") == fingerprint and \
+            os.path.isfile(cpl_path) and os.path.isfile(bom_path):
+        profile.count("cache hits")
+        return []
+
+    with profile.phase("parse pos"):
+        positions = parse_board_pos(pos_content.splitlines(), sides)
+    with profile.phase("parse netlist and join"):
+        components, missing = join_positions(
+            iter_components_from_xml(xml_path), positions)
+    profile.set("components", len(components))
+    profile.set("missing", len(missing))
+    if missing:
+        print("Warning: no position for {0} component(s): {1}".format(
+            len(missing), ", ".join(missing)), file=sys.stderr)
+
+    with profile.phase("write"):
+        outputs = cache.get("outputs", {})
+        written = []
+        for name, csv_path, header, rows in (
+                ("cpl", cpl_path, CPL_HEADER, get_cpl_rows(components)),
+                ("bom", bom_path, get_bom_header(grouped),
+                 get_bom_rows(components, grouped))):
+            outputs[name], was_written = update_csv(csv_path, header, rows,
+                                                    outputs.get(name))
+            if was_written:
+                written.append(csv_path)
+        save_build_cache(cache_path, {"fingerprint": fingerprint,
+                                      "outputs": outputs})
+    profile.set("files written", len(written))
+    return written
+
+
+def load_manifest(manifest_path):
+    """Loads a batch manifest: a json list of projects, each one being a dict
+    with project_name, xml and pos keys (and optional out_dir, sides and
+    grouped).
+    Relative paths are relative to the manifest directory."""
+    base_dir = os.path.dirname(os.path.realpath(manifest_path))
+    with open(manifest_path) as manifest_file:
+        projects = json.load(manifest_file)
+    for project in projects:
+        for key in ("xml", "pos", "out_dir"):
+            if project.get(key) is not None:
+                project[key] = os.path.join(base_dir, project[key])
+    return projects
+
+
+def _build_project(project):
+    """Builds a single manifest project.
+    Returns (name, status, elapsed, profile as a dict)"""
+    start = time.perf_counter()
+    profile = Profile("jlcpcb")
+    try:
+        with open(project["pos"]) as pos_file:
+            written = jlcpcb_build(project["xml"], pos_file,
+                                   project["project_name"],
+                                   project["out_dir"], project.get("sides"),
+                                   project.get("grouped", False),
+                                   project.get("use_cache", True), profile)
+        status = "ok" if written else "up to date"
+    except Exception as e:
+        status = "failed: {0}".format(e)
+    return (project["project_name"], status, time.perf_counter() - start,
+            profile.as_dict())
+
+
+def batch_build(projects, out_dir, sides=None, jobs=None, grouped=False,
+                use_cache=True):
+    """Builds the BOM/CPL of all the given projects over a process pool.
+    Returns the list of (name, status, elapsed, profile), in manifest
+    order."""
+    for project in projects:
+        if project.get("out_dir") is None:
+            project["out_dir"] = out_dir
+        if project.get("sides") is None:
+            project["sides"] = sides
+        project.setdefault("grouped", grouped)
+        project.setdefault("use_cache", use_cache)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_build_project, projects))
+
+
+def print_batch_summary(results):
+    """Prints the per project status and timing"""
+    width = max([len(name) for name, _, _, _ in results] + [len("Project")])
+    print("{0:<{1}}  {2:>9}  {3}".format("Project", width, "Time (s)",
+                                        "Status"))
+    for name, status, elapsed, _ in results:
+        print("{0:<{1}}  {2:>9.3f}  {3}".format(name, width, elapsed, status))
 
-    create_cpl(components, out_dir, project_name)
-    create_bom(components, out_dir, project_name)
 
 if __name__ == "__main__":
+    batch_mode = sys.argv[1:2] == ["batch"]
     parser = argparse.ArgumentParser()
     side_group = parser.add_mutually_exclusive_group()
     side_group.add_argument("--top_only", action="store_true",
@@ -118,12 +517,23 @@ if __name__ == "__main__":
     side_group.add_argument("--bottom_only", action="store_true",
                             help="Process only top side")
     parser.add_argument("-o", default=None, help="output directory")
-    parser.add_argument("project_name", help="project name")
-    parser.add_argument("xml", help="skidl generated board xml file")
-    parser.add_argument("pos", type=argparse.FileType("r"),
-                        help="kicad generated board pos file")
+    parser.add_argument("--grouped", action="store_true",
+                        help="Group identical parts in a single BOM row")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="Regenerate outputs even if unchanged inputs")
+    add_profile_argument(parser)
+    if batch_mode:
+        parser.prog += " batch"
+        parser.add_argument("-j", "--jobs", type=int, default=None,
+                            help="number of worker processes")
+        parser.add_argument("manifest", help="json manifest of the projects")
+    else:
+        parser.add_argument("project_name", help="project name")
+        parser.add_argument("xml", help="skidl generated board xml file")
+        parser.add_argument("pos", type=argparse.FileType("r"),
+                            help="kicad generated board pos file")
 
-    args = parser.parse_args()
+    args = parser.parse_args(sys.argv[2:] if batch_mode else None)
 
     # Layer choice
     if args.top_only:
@@ -139,4 +549,20 @@ if __name__ == "__main__":
     else:
         out_dir = args.o
 
-    jlcpcb_build(args.xml, args.pos, args.project_name, out_dir, sides)
+    if batch_mode:
+        batch_results = batch_build(load_manifest(args.manifest), out_dir,
+                                    sides, args.jobs, args.grouped,
+                                    not args.no_cache)
+        print_batch_summary(batch_results)
+        if args.profile is not None:
+            dump_json({name: profile
+                       for name, _, _, profile in batch_results}, args.profile)
+        if any(status.startswith("failed")
+               for _, status, _, _ in batch_results):
+            sys.exit(1)
+    else:
+        main_profile = Profile("jlcpcb")
+        jlcpcb_build(args.xml, args.pos, args.project_name, out_dir, sides,
+                     args.grouped, not args.no_cache, main_profile)
+        if args.profile is not None:
+            main_profile.dump(args.profile)
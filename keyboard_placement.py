@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Keyboard matrix placement generator.
+Computes the switch (SW_Cherry_MX_*u_PCB), diode and LED placement of a
+keyboard from a compact layout description, and applies it to a board in a
+single indexed pass (or writes it as a placement file).
+
+Layout description (yaml or json):
+    unit: 19.05                 # key pitch (mm)
+    origin: [20, 20]            # top left corner of the first row (mm)
+    switch: {prefix: SW}
+    diode: {prefix: D, offset: [0, 8], rotation: 90, flipped: true}
+    led: {prefix: LED, offset: [0, -4.7], rotation: 180}
+    rows:
+      - [1, 1, 1, 1, 2]
+      - [1.5, 1, 1, iso]
+      - [{gap: 1.25, w: 1.25}, 6.25, {w: 1.25, r: 90}]
+
+A key is a width (in units), "iso" (ISO enter) or a dict with:
+w (width), h (height), gap (units skipped before the key), r (rotation,
+degrees counterclockwise around the key center). A row may be a dict with
+"keys" and "y" (units, default: the next row). The diode and led sections
+are optional, offsets (mm) are relative to the key center and rotate with
+it. The switch offset (from the stem to the footprint origin, MX by default)
+is in the footprint frame instead: it follows the switch rotation and side
+too. Designators are numbered in reading order (SW1, D1, LED1...)."""
+
+import sys
+import json
+import math
+import argparse
+from array import array
+from itertools import accumulate
+
+import yaml
+
+from placement_io import FORMATS, SafeLoader, save_placement
+from profiling import Profile, add_profile_argument
+
+
+UNIT = 19.05
+# KiCad internal units per mm
+IU_PER_MM = 1000000
+# Stem (key center) of the MX footprints, relative to their origin (mm)
+MX_CENTER = (-2.54, 5.08)
+# ISO enter: 1.25u wide and 2u tall, the stem being in the middle
+ISO_ENTER = {"w": 1.25, "h": 2}
+
+
+def load_layout(path):
+    """Loads a layout description (yaml or json)"""
+    with open(path) as layout_file:
+        if path.endswith(".json"):
+            return json.load(layout_file)
+        return yaml.load(layout_file, Loader=SafeLoader)
+
+
+def _normalize_key(key):
+    """Returns the (gap, width, height, rotation) of a key description"""
+    if key == "iso":
+        key = ISO_ENTER
+    elif not isinstance(key, dict):
+        key = {"w": key}
+    return (float(key.get("gap", 0)), float(key.get("w", 1)),
+            float(key.get("h", 1)), float(key.get("r", 0)))
+
+
+def get_key_grid(rows):
+    """Returns the key centers and rotations (in units and degrees) as
+    columns: (x, y, rotation) arrays, in reading order"""
+    xs, ys, rotations = array("d"), array("d"), array("d")
+    row_y = 0.0
+    for row in rows:
+        if isinstance(row, dict):
+            row_y = float(row.get("y", row_y))
+            row = row["keys"]
+        keys = [_normalize_key(key) for key in row]
+        # Left edge of each key: running sum of the previous gaps and widths
+        steps = [gap + width for gap, width, _, _ in keys]
+        lefts = [left - width for left, (_, width, _, _)
+                 in zip(accumulate(steps), keys)]
+        xs.extend(left + width / 2 for left, (_, width, _, _)
+                  in zip(lefts, keys))
+        ys.extend(row_y + height / 2 for _, _, height, _ in keys)
+        rotations.extend(rotation for _, _, _, rotation in keys)
+        row_y += 1
+    return xs, ys, rotations
+
+
+def _rotate(dx, dy, rotations):
+    """Rotates a (mm) offset by each of the rotations (degrees).
+    Returns the (x, y) columns. KiCad y axis goes down, so counterclockwise
+    is (x cos + y sin, -x sin + y cos)"""
+    radians = [math.radians(rotation) for rotation in rotations]
+    cosines = array("d", [math.cos(angle) for angle in radians])
+    sines = array("d", [math.sin(angle) for angle in radians])
+    return (array("d", [dx * c + dy * s for c, s in zip(cosines, sines)]),
+            array("d", [-dx * s + dy * c for c, s in zip(cosines, sines)]))
+
+
+def _to_iu(values):
+    """Converts a mm column to KiCad internal units"""
+    return array("q", [int(round(value * IU_PER_MM)) for value in values])
+
+
+def generate_placement(layout):
+    """Yields the (designator, placement) of all the switches, diodes and
+    LEDs of a layout"""
+    unit = float(layout.get("unit", UNIT))
+    origin_x, origin_y = layout.get("origin", (0, 0))
+    xs, ys, rotations = get_key_grid(layout["rows"])
+    center_x = array("d", [origin_x + x * unit for x in xs])
+    center_y = array("d", [origin_y + y * unit for y in ys])
+
+    components = [("switch", {"prefix": "SW",
+                              "offset": [-MX_CENTER[0], -MX_CENTER[1]],
+                              **layout.get("switch", {})})]
+    components += [(name, layout[name]) for name in ("diode", "led")
+                   if layout.get(name) is not None]
+    for name, params in components:
+        base_rotation = float(params.get("rotation", 0))
+        flipped = bool(params.get("flipped", False))
+        dx, dy = params.get("offset", (0, 0))
+        if name == "switch":
+            # Footprint frame: KiCad mirrors the pads of a flipped footprint
+            # around its x axis, then rotates them with the footprint
+            if flipped:
+                dy = -dy
+            frame = [rotation + base_rotation for rotation in rotations]
+        else:
+            frame = rotations
+        offset_x, offset_y = _rotate(dx, dy, frame)
+        pos_x = _to_iu(cx + ox for cx, ox in zip(center_x, offset_x))
+        pos_y = _to_iu(cy + oy for cy, oy in zip(center_y, offset_y))
+        first = int(params.get("first", 1))
+        for i, (x, y, rotation) in enumerate(zip(pos_x, pos_y, rotations)):
+            # KiCad orientations are in tenths of degree
+            yield "{0}{1}".format(params.get("prefix", name.upper()),
+                                  first + i), \
+                {"flipped": flipped,
+                 "orientation": ((rotation + base_rotation) % 360) * 10,
+                 "position": [x, y]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Keyboard placement generator")
+    add_profile_argument(parser)
+    parser.add_argument("layout", help="The layout description")
+    parser.add_argument("src_pcb", nargs="?", default=None,
+                        help="The initial PCB")
+    parser.add_argument("dst_pcb", nargs="?", default=None,
+                        help="The final PCB")
+    parser.add_argument("-o", "--output", default=None,
+                        help="write the placement to this file instead "
+                             "('-' for stdout)")
+    parser.add_argument("--format", choices=sorted(FORMATS), default=None,
+                        help="placement format (default: from the file "
+                             "extension, else yaml)")
+    args = parser.parse_args()
+    if args.output is None and args.dst_pcb is None:
+        parser.error("either a source and a destination PCB or -o is needed")
+
+    # Only needed to apply the placement to a board
+    from pcbnew import LoadBoard
+    from pcb_explorer import ModuleIndex, apply_placement
+
+    profile = Profile("keyboard_placement")
+    with profile.phase("load layout"):
+        the_layout = load_layout(args.layout)
+    if args.output is not None:
+        with profile.phase("generate"):
+            the_placement = dict(generate_placement(the_layout))
+        with profile.phase("serialize"):
+            save_placement(the_placement, args.output, args.format)
+        profile.set("modules", len(the_placement))
+    else:
+        with profile.phase("load board"):
+            the_pcb = LoadBoard(args.src_pcb)
+        with profile.phase("index"):
+            module_index = ModuleIndex(the_pcb)
+        with profile.phase("apply"):
+            missing_designators = apply_placement(
+                the_pcb, generate_placement(the_layout), module_index)
+        for designator in missing_designators:
+            print("Warning: {0} is not on the board".format(designator),
+                  file=sys.stderr)
+        with profile.phase("save"):
+            the_pcb.Save(args.dst_pcb)
+        profile.set("missing", len(missing_designators))
+
+    if args.profile is not None:
+        profile.dump(args.profile)
@@ -2,34 +2,24 @@
 
 
 import argparse
+import hashlib
+import io
+import json
 import logging
 import os
 import os.path
-import re
 import shutil
 import sys
+import time
 
 import kinparse
 
 import pcbnew
 
-from six import string_types
 from pckg_info import __version__
-
-
-def rmv_quotes(s):
-    """Remove starting and ending quotes from a string."""
-    if not isinstance(s, string_types):
-        return s
-
-    mtch = re.match(r'^\s*"(.*)"\s*$', s)
-    if mtch:
-        try:
-            s = s.decode(mtch.group(1))
-        except (AttributeError, LookupError):
-            s = mtch.group(1)
-
-    return s
+from profiling import Profile, add_profile_argument
+import fp_index
+import sexpr
 
 
 def get_global_fp_lib_table_dir():
@@ -49,71 +39,246 @@ def get_global_fp_lib_table_dir():
     return ""
 
 
+def get_fp_lib_table_cache_path():
+    """Get the path of the on-disk cache of parsed fp-lib-table files."""
+    return os.path.join(fp_index.get_user_cache_dir(), "fp-lib-table.json")
+
+
+def parse_fp_lib_table(fp):
+    """Parse an fp-lib-table stream into a {nickname: raw URI} dict."""
+    libs = {}
+    for lib in sexpr.iter_nodes(fp, heads={"lib"}):
+        # Gather the (key value) entries of the library.
+        entries = {}
+        for item in lib[1:]:
+            if isinstance(item, list) and item:
+                entries[item[0].lower()] = item[1] if len(item) > 1 else None
+
+        # Skip disabled libraries.
+        if "disabled" in entries:
+            continue
+
+        # Skip non-KiCad libraries (primarily git repos).
+        if str(entries.get("type", "")).lower() != "kicad":
+            continue
+
+        if entries.get("name") is None or entries.get("uri") is None:
+            continue
+        libs[entries["name"]] = entries["uri"]
+    return libs
+
+
 class LibURIs(dict):
     """Dict for storing library URIs from all directories in fp-lib-table file."""
 
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         super(self.__class__, self).__init__()
+        self.cache_path = kwargs.get("cache_path", get_fp_lib_table_cache_path())
+        self.cache = self.load_cache()
+        self.cache_dirty = False
+        loaded = set()
         for fp_lib_table_dir in args:
+            # Don't scan the same table twice (e.g. "." and $KIPRJMOD).
+            real_dir = os.path.realpath(fp_lib_table_dir)
+            if real_dir in loaded:
+                continue
+            loaded.add(real_dir)
             self.load(fp_lib_table_dir)
+        if self.cache_dirty:
+            self.save_cache()
+
+    def load_cache(self):
+        """Load the on-disk cache of parsed fp-lib-table files."""
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+    def save_cache(self):
+        """Save the on-disk cache of parsed fp-lib-table files."""
+        if self.cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = self.cache_path + ".{}.tmp".format(os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump(self.cache, fp)
+            os.replace(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            pass
+
+    def get_libs(self, fp_lib_table):
+        """Get the raw URIs of a fp-lib-table file, reparsing it only if it
+        changed since it was cached (checked by mtime/size, then hash)."""
+        stat = os.stat(fp_lib_table)
+        entry = self.cache.get(fp_lib_table)
+        if (
+            entry
+            and entry["mtime"] == stat.st_mtime_ns
+            and entry["size"] == stat.st_size
+        ):
+            return entry["libs"]
+
+        with open(fp_lib_table, "rb") as fp:
+            content = fp.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if not entry or entry["sha256"] != digest:
+            libs = parse_fp_lib_table(io.StringIO(content.decode("utf-8")))
+        else:
+            libs = entry["libs"]
+        self.cache[fp_lib_table] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": digest,
+            "libs": libs,
+        }
+        self.cache_dirty = True
+        return libs
 
     def load(self, fp_lib_table_dir):
         """Load cache with URIs for libraries in fp-lib-table file."""
-        # Read contents of footprint library file into a single string.
+        fp_lib_table = os.path.realpath(os.path.join(fp_lib_table_dir, "fp-lib-table"))
         try:
-            with open(os.path.join(fp_lib_table_dir, "fp-lib-table")) as fp:
-                tbl = fp.read()
-        except IOError:
+            libs = self.get_libs(fp_lib_table)
+        except (IOError, OSError):
             return
 
-        # Get individual "(lib ...)" entries from the string.
-        libs = re.findall(
-            r"\(\s*lib\s* .*? \)\)", tbl, flags=re.IGNORECASE | re.VERBOSE | re.DOTALL
-        )
+        # Expand variables and ~ in the URIs (not cached: they depend on the
+        # environment, e.g. KIPRJMOD).
+        for nickname, uri in libs.items():
+            self[nickname] = os.path.expandvars(os.path.expanduser(uri))
 
-        # Add the footprint modules found in each enabled KiCad libray.
-        for lib in libs:
 
-            # Skip disabled libraries.
-            disabled = re.findall(
-                r"\(\s*disabled\s*\)", lib, flags=re.IGNORECASE | re.VERBOSE
-            )
-            if disabled:
-                continue
-
-            # Skip non-KiCad libraries (primarily git repos).
-            type_ = re.findall(
-                r'(?:\(\s*type\s*) ("[^"]*?"|[^)]*?) (?:\s*\))',
-                lib,
-                flags=re.IGNORECASE | re.VERBOSE,
-            )[0]
-            if type_.lower() != "kicad":
-                continue
+class FootprintCache(object):
+    """Cache of loaded footprints, keyed on (library, footprint name, file mtime).
+    Each footprint is loaded once and cloned for every instance."""
 
-            # Get the library directory and nickname.
-            uri = re.findall(
-                r'(?:\(\s*uri\s*) ("[^"]*?"|[^)]*?) (?:\s*\))',
-                lib,
-                flags=re.IGNORECASE | re.VERBOSE,
-            )[0]
-            nickname = re.findall(
-                r'(?:\(\s*name\s*) ("[^"]*?"|[^)]*?) (?:\s*\))',
-                lib,
-                flags=re.IGNORECASE | re.VERBOSE,
-            )[0]
-
-            # Remove any quotes around the URI or nickname.
-            uri = rmv_quotes(uri)
-            nickname = rmv_quotes(nickname)
-
-            # Expand variables and ~ in the URI.
-            uri = os.path.expandvars(os.path.expanduser(uri))
-
-            self[nickname] = uri
+    def __init__(self):
+        self.prototypes = {}
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
 
+    def get(self, lib_uri, fp_name):
+        """Return a new module instance of the given footprint."""
+        fp_path = os.path.join(lib_uri, fp_name + ".kicad_mod")
+        try:
+            mtime = os.stat(fp_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        key = (lib_uri, fp_name, mtime)
+
+        prototype = self.prototypes.get(key)
+        if prototype is None:
+            self.misses += 1
+            start = time.perf_counter()
+            prototype = pcbnew.FootprintLoad(lib_uri, fp_name)
+            self.load_time += time.perf_counter() - start
+            self.prototypes[key] = prototype
+        else:
+            self.hits += 1
+
+        # Hand out copies so the prototype stays pristine.
+        return pcbnew.MODULE(prototype)
+
+    def hit_rate(self):
+        """Return the ratio of footprint requests served from the cache."""
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+def build_pad_index(module):
+    """Return a {pad name: pad} dict of a module (first pad wins, as with
+    FindPadByName)."""
+    pads = {}
+    for pad in module.Pads():
+        pads.setdefault(pad.GetName(), pad)
+    return pads
+
+
+def check_footprints(parts, fp_libs, logger):
+    """Check with the footprint library indexes that the footprints of all the
+    parts exist and are well formed, before building anything. All the
+    problems are logged, then a ValueError is raised if there are any."""
+    indexes = {}
+    problems = 0
+    footprints = {tuple(part.footprint.split(":")) for part in parts}
+    for fp_lib, fp_name in sorted(footprints):
+        lib_uri = fp_libs.get(fp_lib)
+        if lib_uri is None:
+            logger.error("Unknown footprint library %s", fp_lib)
+            problems += 1
+            continue
+        if not os.path.isdir(lib_uri):
+            continue
+        if lib_uri not in indexes:
+            indexes[lib_uri] = fp_index.get_index(lib_uri)
+        entry = indexes[lib_uri].get(fp_name)
+        if entry is None:
+            logger.error("Missing footprint %s:%s", fp_lib, fp_name)
+            problems += 1
+        elif "error" in entry:
+            logger.error(
+                "Malformed footprint %s:%s (%s)", fp_lib, fp_name, entry["error"]
+            )
+            problems += 1
+    if problems:
+        raise ValueError("{} footprint problem(s), see the log".format(problems))
+    return indexes
+
+
+def same_footprint(module, fp_lib, fp_name):
+    """Return True if the module was created from the given footprint."""
+    fpid = module.GetFPID()
+    if str(fpid.GetLibItemName()) != fp_name:
+        return False
+    return str(fpid.GetLibNickname()) in ("", fp_lib)
+
+
+def remove_stale_nets(brd, netlist_nets):
+    """Removes the board nets that left the netlist and that no pad uses
+    anymore (pads of modules added by hand keep their nets). Their tracks and
+    zones are left unconnected. Returns the number of removed nets."""
+    used = {pad.GetNetCode() for pad in brd.GetPads()}
+    stale = {}
+    for name, net in list(brd.GetNetsByName().items()):
+        name = str(name)
+        code = net.GetNet()
+        if code != 0 and name not in netlist_nets and code not in used:
+            stale[code] = net
+    if not stale:
+        return 0
+
+    for track in brd.GetTracks():
+        if track.GetNetCode() in stale:
+            track.SetNetCode(0)
+    for i in range(brd.GetAreaCount()):
+        zone = brd.GetArea(i)
+        if zone.GetNetCode() in stale:
+            zone.SetNetCode(0)
+    for net in stale.values():
+        brd.Remove(net)
+    return len(stale)
+
+
+def kinet2pcb(
+    netlist_filename, brd_filename=None, update=False, headless=None, profile=None
+):
+    """Create a .kicad_pcb from a KiCad netlist file.
+    With update, an existing .kicad_pcb is updated instead: only the parts and
+    nets that changed are touched, the nets that left the netlist are removed
+    and the existing placement is kept.
+    The GUI is refreshed only if not headless (by default, headless unless
+    running inside PCBNEW). Returns the profile (phase timings and counters)."""
 
-def kinet2pcb(netlist_filename, brd_filename=None):
-    """Create a .kicad_pcb from a KiCad netlist file."""
+    logger = logging.getLogger("kinet2pcb")
+    if headless is None:
+        headless = pcbnew.GetBoard() is None
+    if profile is None:
+        profile = Profile("kinet2pcb")
 
     # Get the global and local fp-lib-table file URIs.
     paths = [get_global_fp_lib_table_dir(), "."]
@@ -121,64 +286,176 @@ def kinet2pcb(netlist_filename, brd_filename=None):
         paths.append(os.environ["KIPRJMOD"])
     fp_libs = LibURIs(*paths)
 
-    # Create a blank KiCad PCB file based on the name of the netlist file.
+    # Create a blank KiCad PCB file based on the name of the netlist file
+    # (or load the existing one when updating).
     if brd_filename is None:
         base_filename = os.path.splitext(netlist_filename)[0]
         brd_filename = base_filename + ".kicad_pcb"
-    brd = pcbnew.BOARD()
+    if update and os.path.isfile(brd_filename):
+        brd = pcbnew.LoadBoard(brd_filename)
+    else:
+        update = False
+        brd = pcbnew.BOARD()
 
     # Parse the netlist.
-    netlist = kinparse.parse_netlist(netlist_filename)
+    with profile.phase("parse"):
+        netlist = kinparse.parse_netlist(netlist_filename)
+
+    # Check the footprints up front instead of failing in the middle of the run.
+    with profile.phase("footprint check"):
+        check_footprints(netlist.parts, fp_libs, logger)
+
+    # Modules already on the board, by reference.
+    start = time.perf_counter()
+    existing = {}
+    if update:
+        for module in brd.GetModules():
+            existing[module.GetReference()] = module
+    kept = replaced = 0
 
     # Add the components in the netlist to the PCB.
+    fp_cache = FootprintCache()
+    pad_index = {}
     for part in netlist.parts:
         # Get the library and footprint name for the part.
         fp_lib, fp_name = part.footprint.split(":")
 
+        # Keep an existing module (and its placement) if its footprint is
+        # unchanged: only refresh its data.
+        old_module = existing.pop(part.ref, None)
+        if old_module is not None and same_footprint(old_module, fp_lib, fp_name):
+            if old_module.GetValue() != part.value:
+                old_module.SetValue(part.value)
+            old_module.SetPath(part.sheetpath.names)
+            pad_index[part.ref] = build_pad_index(old_module)
+            kept += 1
+            continue
+
         # Get the URI of the library directory.
         lib_uri = fp_libs[fp_lib]
 
-        # Create a module from the footprint file.
-        fp = pcbnew.FootprintLoad(lib_uri, fp_name)
+        # Create a module from the (cached) footprint file.
+        fp = fp_cache.get(lib_uri, fp_name)
 
         # Set the module parameters based on the part data.
         fp.SetParent(brd)
+        fp.SetFPID(pcbnew.LIB_ID(fp_lib, fp_name))
         fp.SetReference(part.ref)
         fp.SetValue(part.value)
         # fp.SetTimeStamp(part.sheetpath.tstamps)
         fp.SetPath(part.sheetpath.names)
 
+        # A module whose footprint changed is replaced in place.
+        if old_module is not None:
+            if old_module.IsFlipped():
+                fp.Flip(fp.GetPosition())
+            fp.SetOrientation(old_module.GetOrientation())
+            fp.SetPosition(old_module.GetPosition())
+            brd.Remove(old_module)
+            replaced += 1
+
         # Add the module to the PCB.
         brd.Add(fp)
 
-    # Add the nets in the netlist to the PCB.
-    cnct = brd.GetConnectivity()
+        # Index the pads of the module for the net connections.
+        pad_index[part.ref] = build_pad_index(fp)
+
+    # Remove the netlisted modules that are no longer in the netlist (modules
+    # added by hand have no path and are left alone).
+    removed = 0
+    for module in existing.values():
+        if module.GetPath():
+            brd.Remove(module)
+            removed += 1
+    profile.add_time("footprint load", fp_cache.load_time)
+    profile.add_time("placement", time.perf_counter() - start - fp_cache.load_time)
+    profile.set("parts", len(pad_index))
+    profile.set("footprints loaded", fp_cache.misses)
+    profile.set("footprint cache hits", fp_cache.hits)
+
+    logger.debug(
+        "Footprint cache: %d loaded, %d hits (%.1f%% hit rate)",
+        fp_cache.misses,
+        fp_cache.hits,
+        100 * fp_cache.hit_rate(),
+    )
+    if update:
+        logger.debug(
+            "Update: %d kept, %d replaced, %d added, %d removed",
+            kept,
+            replaced,
+            len(pad_index) - kept - replaced,
+            removed,
+        )
+
+    # Collect the pad -> net assignments of the netlist, with a single PCB
+    # net per net name.
+    start = time.perf_counter()
+    pcb_nets = {}
+    assignments = {}
     for net in netlist.nets:
 
-        # Create a net with the current net name.
-        pcb_net = pcbnew.NETINFO_ITEM(brd, net.name)
+        # Create a net with the current net name (or reuse the existing one).
+        pcb_net = pcb_nets.get(net.name)
+        if pcb_net is None:
+            pcb_net = brd.FindNet(net.name) if update else None
+            if pcb_net is None:
+                pcb_net = pcbnew.NETINFO_ITEM(brd, net.name)
 
-        # Add the net to the PCB.
-        brd.Add(pcb_net)
+                # Add the net to the PCB.
+                brd.Add(pcb_net)
+            pcb_nets[net.name] = pcb_net
 
-        # Connect the part pins on the netlist net to the PCB net.
         for pin in net.pins:
 
             # Find the PCB module pad for the current part pin.
-            module = brd.FindModuleByReference(pin.ref)
-            pad = module.FindPadByName(pin.num)
-
-            # Connect the pad to the PCB net.
-            cnct.Add(pad)
-            pad.SetNet(pcb_net)
-
-    # Recalculate the PCB part and net data.
-    brd.BuildListOfNets()
-    cnct.RecalculateRatsnest()
-    pcbnew.Refresh()
+            pad = pad_index.get(pin.ref, {}).get(pin.num)
+            if pad is None:
+                logger.warning(
+                    "No pad %s on %s for net %s", pin.num, pin.ref, net.name
+                )
+                continue
+            assignments[(pin.ref, pin.num)] = (pad, net.name)
+
+    # Apply all the assignments in one batch. When updating, only the pads
+    # whose net changed are touched.
+    renetted = 0
+    for pad, net_name in assignments.values():
+        if not update or pad.GetNetname() != net_name:
+            pad.SetNet(pcb_nets[net_name])
+            renetted += 1
+    if update:
+        # Disconnect the pads that are no longer on any net.
+        for ref, pads in pad_index.items():
+            for name, pad in pads.items():
+                if (ref, name) not in assignments and pad.GetNetCode() != 0:
+                    pad.SetNetCode(0)
+                    renetted += 1
+        removed_nets = remove_stale_nets(brd, pcb_nets)
+        logger.debug("%d nets removed", removed_nets)
+        profile.set("nets removed", removed_nets)
+    logger.debug("%d nets, %d pads netted", len(pcb_nets), renetted)
+    profile.add_time("netting", time.perf_counter() - start)
+    profile.set("nets", len(pcb_nets))
+    profile.set("pads", len(assignments))
+    profile.set("pads netted", renetted)
+
+    # Recalculate the PCB part and net data, building the connectivity once
+    # for all the pads.
+    with profile.phase("ratsnest"):
+        brd.BuildListOfNets()
+        brd.BuildConnectivity()
+        brd.GetConnectivity().RecalculateRatsnest()
+        if not headless:
+            pcbnew.Refresh()
 
     # Save the PCB into the KiCad PCB file.
-    pcbnew.SaveBoard(brd_filename, brd)
+    with profile.phase("save"):
+        pcbnew.SaveBoard(brd_filename, brd)
+
+    for phase, duration in profile.phases.items():
+        logger.debug("%s: %.3f s", phase, duration)
+    return profile
 
 
 ###############################################################################
@@ -214,6 +491,13 @@ def main():
         action="store_true",
         help="Allow overwriting of an existing board file.",
     )
+    parser.add_argument(
+        "--update",
+        "-u",
+        action="store_true",
+        help="""Update an existing board file: only the changed parts and nets
+            are modified and the placement is kept.""",
+    )
     parser.add_argument(
         "--nobackup",
         "-nb",
@@ -230,6 +514,7 @@ def main():
         metavar="LEVEL",
         help="Print debugging info. (Larger LEVEL means more info.)",
     )
+    add_profile_argument(parser)
 
     args = parser.parse_args()
 
@@ -245,7 +530,7 @@ def main():
         args.output = os.path.splitext(args.input)[0] + ".kicad_pcb"
 
     if os.path.isfile(args.output):
-        if not args.overwrite and args.nobackup:
+        if not (args.overwrite or args.update) and args.nobackup:
             logger.critical(
                 """File {} already exists! Use the --overwrite option to
                 allow modifications to it or allow backups.""".format(
@@ -264,7 +549,9 @@ def main():
                     break  # Backup done, so break out of loop.
                 index += 1  # Else keep looking for an unused backup file name.
 
-    kinet2pcb(args.input, args.output)
+    profile = kinet2pcb(args.input, args.output, update=args.update, headless=True)
+    if args.profile is not None:
+        profile.dump(args.profile)
 
 
 ###############################################################################
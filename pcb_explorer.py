@@ -1,9 +1,14 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from pcbnew import LoadBoard, wxPoint
-from yaml import load, dump, Loader
+from placement_io import FORMATS, load_placement, save_placement
+from placement_io import FORMAT_EXTENSIONS, get_format
+from profiling import Profile, add_profile_argument, dump_json
 
 
 def get_all_designators(pcb):
@@ -11,63 +16,353 @@ def get_all_designators(pcb):
     return [module.GetReference() for module in pcb.GetModules()]
 
 
-def _get_module_from_reference(pcb, reference):
-    """Return the module of the given reference"""
-    for module in pcb.GetModules():
-        if module.GetReference() == reference:
-            return module
-    return None
+class ModuleIndex():
+    """Reference -> module index of a board, built in a single traversal of
+    its modules"""
 
+    def __init__(self, pcb):
+        """Init the brand new instance"""
+        self.pcb = pcb
+        self.modules = {}
+        for module in pcb.GetModules():
+            # Like a linear search, the first module of a reference wins
+            self.modules.setdefault(module.GetReference(), module)
 
-def export_placement(pcb, designators=None):
+    def __contains__(self, reference):
+        return reference in self.modules
+
+    def __len__(self):
+        return len(self.modules)
+
+    def get(self, reference):
+        """Return the module of the given reference (None if unknown)"""
+        return self.modules.get(reference)
+
+    def references(self):
+        """Returns the references of the board"""
+        return list(self.modules)
+
+
+def get_module_placement(module):
+    """Returns the placement (side, orientation, position) of a module"""
+    pos = module.GetPosition()
+    return {"flipped": module.IsFlipped(),
+            "orientation": module.GetOrientation(),
+            "position": [pos.x, pos.y]}
+
+
+def export_placement(pcb, designators=None, index=None):
     """Export placement (side, orientation, position) for given designators"""
+    if index is None:
+        index = ModuleIndex(pcb)
     if designators is None:
-        designators = get_all_designators(pcb)
+        designators = index.references()
     ret = {}
     for designator in designators:
-        module = _get_module_from_reference(pcb, designator)
-        pos = module.GetPosition()
-        ret[designator] = {"flipped": module.IsFlipped(),
-                           "orientation": module.GetOrientation(),
-                           "position": [pos.x, pos.y]}
+        module = index.get(designator)
+        if module is None:
+            raise KeyError("Unknown designator " + designator)
+        ret[designator] = get_module_placement(module)
     return ret
 
 
-def apply_placement(pcb, placement):
-    """Apply placement"""
-    if placement is None:
-        return
+def get_changes(old, new):
+    """Returns the list of the changes ("moved", "rotated", "flipped") from
+    the old to the new placement of a module"""
+    changes = []
+    if list(old["position"]) != list(new["position"]):
+        changes.append("moved")
+    if old["orientation"] != new["orientation"]:
+        changes.append("rotated")
+    if bool(old["flipped"]) != bool(new["flipped"]):
+        changes.append("flipped")
+    return changes
+
+
+def diff_placement(old, new):
+    """Compares two placements. Returns {kind: [designators]} with the kinds
+    "moved", "rotated", "flipped", "added" (only in new) and "missing" (only
+    in old)"""
+    diff = {"moved": [], "rotated": [], "flipped": [], "added": [],
+            "missing": []}
+    for designator, params in new.items():
+        old_params = old.get(designator)
+        if old_params is None:
+            diff["added"].append(designator)
+            continue
+        for change in get_changes(old_params, params):
+            diff[change].append(designator)
+    diff["missing"] = [designator for designator in old
+                       if designator not in new]
+    return diff
+
+
+def get_changed_placement(placement, index):
+    """Returns the part of a placement that differs from the board"""
+    changed = {}
     for designator, params in placement.items():
-        module = _get_module_from_reference(pcb, designator)
-        if params["flipped"] and not(module.IsFlipped()):
+        module = index.get(designator)
+        if module is None or get_changes(get_module_placement(module),
+                                         params):
+            changed[designator] = params
+    return changed
+
+
+def apply_placement(pcb, placement, index=None):
+    """Apply placement (position, orientation and flip of each module in a
+    single pass). placement may also be an iterable of (designator, params),
+    e.g. a generator. Returns the designators missing from the board"""
+    if placement is None:
+        return []
+    if index is None:
+        index = ModuleIndex(pcb)
+    if isinstance(placement, dict):
+        placement = placement.items()
+    missing = []
+    for designator, params in placement:
+        module = index.get(designator)
+        if module is None:
+            missing.append(designator)
+            continue
+        if bool(params["flipped"]) != module.IsFlipped():
             module.Flip(module.GetCenter())
         module.SetOrientation(params["orientation"])
-        pos = wxPoint(*params["position"])
-        module.SetPosition(pos)
+        module.SetPosition(wxPoint(*params["position"]))
+    return missing
+
+
+def load_board_or_placement(path, fmt=None):
+    """Returns the placement of a board (.kicad_pcb) or a placement file"""
+    if path.endswith(".kicad_pcb"):
+        return export_placement(LoadBoard(path))
+    return load_placement(path, fmt)
+
+
+def _dump_board(pcb_path):
+    """Exports the placement of a single board (batch_dump worker).
+    Returns (pcb path, placement or None, status, profile as a dict)"""
+    profile = Profile("pcb_explorer dump")
+    try:
+        with profile.phase("load board"):
+            pcb = LoadBoard(pcb_path)
+        with profile.phase("export"):
+            placement = export_placement(pcb)
+        status = "ok"
+    except Exception as e:
+        placement, status = None, "failed: {0}".format(e)
+    profile.set("modules", len(placement or {}))
+    return pcb_path, placement, status, profile.as_dict()
+
+
+def batch_dump(pcb_paths, jobs=None):
+    """Exports the placement of all the given boards over a process pool, so
+    each worker pays the pcbnew startup once.
+    Returns the list of (pcb path, placement, status, profile), in order"""
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_dump_board, pcb_paths))
+
+
+def get_board_names(pcb_paths):
+    """Returns a unique name per board: its file name without extension or,
+    if several boards share it, its path (without extension) relative to
+    the common directory of the boards. Raises a ValueError if a board is
+    given twice."""
+    real_paths = [os.path.realpath(pcb_path) for pcb_path in pcb_paths]
+    stems = [os.path.splitext(os.path.basename(path))[0]
+             for path in real_paths]
+    common_dir = os.path.commonpath([os.path.dirname(path)
+                                     for path in real_paths])
+    names = []
+    for path, stem in zip(real_paths, stems):
+        if stems.count(stem) > 1:
+            stem = os.path.splitext(os.path.relpath(path, common_dir))[0]
+            stem = stem.replace(os.sep, "/")
+        names.append(stem)
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError("Boards given more than once: "
+                         + ", ".join(duplicates))
+    return names
+
+
+def merge_placements(results, names):
+    """Merges the batch_dump placements into a single one, the designators
+    being prefixed by the board names ("board/R1")"""
+    merged = {}
+    for name, (_, placement, _, _) in zip(names, results):
+        for designator, params in (placement or {}).items():
+            merged[name + "/" + designator] = params
+    return merged
+
+
+def print_batch_summary(results, names, stream=sys.stdout):
+    """Prints the per board status and timing"""
+    width = max([len(name) for name in names] + [len("Board")])
+    print("{0:<{1}}  {2:>7}  {3:>9}  {4}".format("Board", width, "Modules",
+                                                 "Time (s)", "Status"),
+          file=stream)
+    for name, (_, placement, status, profile) in zip(names, results):
+        print("{0:<{1}}  {2:>7}  {3:>9.3f}  {4}".format(
+            name, width, len(placement or {}), profile["total"], status),
+              file=stream)
+
+
+def print_diff(diff, old, new):
+    """Prints a placement diff"""
+    for designator in diff["moved"]:
+        print("moved {0}: {1} -> {2}".format(designator,
+                                             old[designator]["position"],
+                                             new[designator]["position"]))
+    for designator in diff["rotated"]:
+        print("rotated {0}: {1} -> {2}".format(
+            designator, old[designator]["orientation"],
+            new[designator]["orientation"]))
+    for designator in diff["flipped"]:
+        print("flipped {0}: {1} -> {2}".format(
+            designator, old[designator]["flipped"],
+            new[designator]["flipped"]))
+    for kind in ("added", "missing"):
+        for designator in diff[kind]:
+            print("{0} {1}".format(kind, designator))
 
 
 if __name__ == "__main__":
     main_parser = argparse.ArgumentParser("PCB Explorer")
+    add_profile_argument(main_parser)
     sub_parser = main_parser.add_subparsers(dest="command")
 
     # Dump command
     dump_parser = sub_parser.add_parser("dump")
     dump_parser.add_argument("pcb", help="The PCB")
+    dump_parser.add_argument("-o", "--output", default="-",
+                             help="The placement file (default: stdout)")
+    dump_parser.add_argument("--format", choices=sorted(FORMATS),
+                             default=None,
+                             help="placement format (default: from the "
+                                  "file extension, else yaml)")
 
     # Apply command
     apply_parser = sub_parser.add_parser("apply")
     apply_parser.add_argument("src_pcb", help="The initial PCB")
     apply_parser.add_argument("placement", help="The placement file")
     apply_parser.add_argument("dst_pcb", help="The final PCB")
+    apply_parser.add_argument("--format", choices=sorted(FORMATS),
+                              default=None,
+                              help="placement format (default: from the "
+                                   "file extension, else yaml)")
+
+    apply_parser.add_argument("--changed-only", action="store_true",
+                              help="only touch the modules whose placement "
+                                   "differs from the board")
+
+    # Batch dump command
+    batch_parser = sub_parser.add_parser("batch-dump")
+    batch_parser.add_argument("pcbs", nargs="+", help="The PCBs")
+    batch_parser.add_argument("-j", "--jobs", type=int, default=None,
+                              help="number of worker processes")
+    batch_output = batch_parser.add_mutually_exclusive_group()
+    batch_output.add_argument("-o", "--output", default="-",
+                              help="The merged placement file, designators "
+                                   "being prefixed by the board name (its "
+                                   "relative path if several boards share "
+                                   "a file name) (default: stdout)")
+    batch_output.add_argument("--out_dir", default=None,
+                              help="Write one placement file per board in "
+                                   "this directory instead")
+    batch_parser.add_argument("--format", choices=sorted(FORMATS),
+                              default=None,
+                              help="placement format (default: from the "
+                                   "file extension, else yaml)")
+
+    # Diff command
+    diff_parser = sub_parser.add_parser("diff")
+    diff_parser.add_argument("old", help="The reference PCB or placement file")
+    diff_parser.add_argument("new", help="The compared PCB or placement file")
+    diff_parser.add_argument("--format", choices=sorted(FORMATS),
+                             default=None,
+                             help="placement format (default: from the "
+                                  "file extension, else yaml)")
 
     args = main_parser.parse_args()
+    profile = Profile("pcb_explorer " + str(args.command))
+    exit_status = 0
+    board_profiles = None
 
     if args.command == "dump":
-        the_pcb = LoadBoard(args.pcb)
-        the_placement = export_placement(the_pcb)
-        print(dump(the_placement))
+        with profile.phase("load board"):
+            the_pcb = LoadBoard(args.pcb)
+        with profile.phase("export"):
+            the_placement = export_placement(the_pcb)
+        with profile.phase("serialize"):
+            save_placement(the_placement, args.output, args.format)
+        profile.set("modules", len(the_placement))
     elif args.command == "apply":
-        the_pcb = LoadBoard(args.src_pcb)
-        the_placement = load(open(args.placement).read(), Loader=Loader)
-        apply_placement(the_pcb, the_placement)
-        the_pcb.Save(args.dst_pcb)
+        with profile.phase("load board"):
+            the_pcb = LoadBoard(args.src_pcb)
+        with profile.phase("load placement"):
+            the_placement = load_placement(args.placement, args.format)
+        with profile.phase("index"):
+            module_index = ModuleIndex(the_pcb)
+        if args.changed_only:
+            with profile.phase("diff"):
+                the_placement = get_changed_placement(the_placement or {},
+                                                      module_index)
+        with profile.phase("apply"):
+            missing_designators = apply_placement(the_pcb, the_placement,
+                                                  module_index)
+        for designator in missing_designators:
+            print("Warning: {0} is not on the board".format(designator),
+                  file=sys.stderr)
+        with profile.phase("save"):
+            the_pcb.Save(args.dst_pcb)
+        profile.set("modules", len(the_placement or {}))
+        profile.set("missing", len(missing_designators))
+    elif args.command == "batch-dump":
+        try:
+            board_names = get_board_names(args.pcbs)
+        except ValueError as e:
+            main_parser.error(str(e))
+        with profile.phase("dump"):
+            batch_results = batch_dump(args.pcbs, args.jobs)
+        with profile.phase("serialize"):
+            if args.out_dir is None:
+                save_placement(merge_placements(batch_results, board_names),
+                               args.output, args.format)
+            else:
+                out_format = get_format("", args.format)
+                extension = [ext for ext, ext_format
+                             in FORMAT_EXTENSIONS.items()
+                             if ext_format == out_format][0]
+                for board_name, (_, the_placement, _, _) in zip(
+                        board_names, batch_results):
+                    if the_placement is not None:
+                        out_path = os.path.join(args.out_dir,
+                                                board_name + extension)
+                        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                        save_placement(the_placement, out_path, out_format)
+        # stdout may hold the placement
+        print_batch_summary(batch_results, board_names, sys.stderr)
+        profile.set("boards", len(batch_results))
+        board_profiles = {pcb_path: board_profile
+                          for pcb_path, _, _, board_profile in batch_results}
+        if any(status.startswith("failed")
+               for _, _, status, _ in batch_results):
+            exit_status = 1
+    elif args.command == "diff":
+        with profile.phase("load"):
+            old_placement = load_board_or_placement(args.old, args.format)
+            new_placement = load_board_or_placement(args.new, args.format)
+        with profile.phase("diff"):
+            the_diff = diff_placement(old_placement, new_placement)
+        print_diff(the_diff, old_placement, new_placement)
+        for kind, designators in the_diff.items():
+            profile.set(kind, len(designators))
+        exit_status = 1 if any(the_diff.values()) else 0
+
+    if args.profile is not None:
+        if board_profiles is None:
+            profile.dump(args.profile)
+        else:
+            dump_json({"batch": profile.as_dict(), "boards": board_profiles},
+                      args.profile)
+    sys.exit(exit_status)
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Placement file formats of pcb_explorer.
+A placement is a {designator: {"flipped", "orientation", "position"}} dict.
+Supported formats:
+ - yaml: the historical format (C accelerated safe loader/dumper if
+   available)
+ - jsonl: one json object per designator, read and written as a stream
+ - bin: compact columnar file (designator table, then x, y, orientation and
+   flip arrays)"""
+
+import sys
+import json
+import struct
+from array import array
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+BIN_MAGIC = b"KPLC"
+BIN_VERSION = 1
+# magic, version, designator count, designator table size
+BIN_HEADER = struct.Struct("<4sIII")
+# (array typecode, column) of the binary format, in file order
+BIN_COLUMNS = [("q", "x"), ("q", "y"), ("d", "orientation"), ("B", "flipped")]
+
+FORMAT_EXTENSIONS = {".yaml": "yaml", ".yml": "yaml",
+                     ".jsonl": "jsonl",
+                     ".bin": "bin", ".plc": "bin"}
+
+
+def get_format(path, fmt=None):
+    """Returns the format of a placement file: fmt if given, else guessed
+    from the extension (yaml by default, e.g. for stdin/stdout)"""
+    if fmt is not None:
+        if fmt not in FORMATS:
+            raise ValueError("Unknown placement format " + fmt)
+        return fmt
+    for extension, ext_fmt in FORMAT_EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return ext_fmt
+    return "yaml"
+
+
+def _entry(flipped, orientation, x, y):
+    """Returns the placement entry of a module"""
+    return {"flipped": flipped, "orientation": orientation,
+            "position": [x, y]}
+
+
+# YAML
+
+def load_yaml(stream):
+    """Loads a yaml placement"""
+    return yaml.load(stream, Loader=SafeLoader) or {}
+
+
+def dump_yaml(placement, stream):
+    """Dumps a placement as yaml"""
+    yaml.dump(placement, stream, Dumper=SafeDumper)
+
+
+# JSON lines
+
+def iter_jsonl(stream):
+    """Yields the (designator, entry) of a json-lines placement stream"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line)
+        yield item["ref"], _entry(item["flipped"], item["orientation"],
+                                  *item["position"])
+
+
+def load_jsonl(stream):
+    """Loads a json-lines placement"""
+    return dict(iter_jsonl(stream))
+
+
+def dump_jsonl(placement, stream):
+    """Dumps a placement as json lines, one designator per line"""
+    for designator, params in placement.items():
+        stream.write(json.dumps({"ref": designator, **params},
+                                separators=(",", ":")))
+        stream.write("\n")
+
+
+# Binary (columnar)
+
+def _to_little_endian(column):
+    """Byte swaps an array in place on big endian hosts"""
+    if sys.byteorder == "big":
+        column.byteswap()
+
+
+def load_bin(stream):
+    """Loads a binary placement"""
+    magic, version, count, table_size = BIN_HEADER.unpack(
+        stream.read(BIN_HEADER.size))
+    if magic != BIN_MAGIC or version != BIN_VERSION:
+        raise ValueError("Not a placement file (or unsupported version)")
+    designators = stream.read(table_size).decode("utf-8").split("\0") \
+        if count else []
+    columns = {}
+    for typecode, name in BIN_COLUMNS:
+        column = array(typecode)
+        column.frombytes(stream.read(count * column.itemsize))
+        if len(column) != count:
+            raise ValueError("Truncated placement file")
+        _to_little_endian(column)
+        columns[name] = column
+    return {designator: _entry(bool(flipped), orientation, x, y)
+            for designator, x, y, orientation, flipped
+            in zip(designators, columns["x"], columns["y"],
+                   columns["orientation"], columns["flipped"])}
+
+
+def dump_bin(placement, stream):
+    """Dumps a placement as a binary file"""
+    table = "\0".join(placement).encode("utf-8")
+    values = placement.values()
+    columns = {"x": [params["position"][0] for params in values],
+               "y": [params["position"][1] for params in values],
+               "orientation": [params["orientation"] for params in values],
+               "flipped": [params["flipped"] for params in values]}
+    stream.write(BIN_HEADER.pack(BIN_MAGIC, BIN_VERSION, len(placement),
+                                 len(table)))
+    stream.write(table)
+    for typecode, name in BIN_COLUMNS:
+        column = array(typecode, columns[name])
+        _to_little_endian(column)
+        stream.write(column.tobytes())
+
+
+# (loader, dumper, binary stream)
+FORMATS = {"yaml": (load_yaml, dump_yaml, False),
+           "jsonl": (load_jsonl, dump_jsonl, False),
+           "bin": (load_bin, dump_bin, True)}
+
+
+def load_placement(path, fmt=None):
+    """Loads a placement file ('-' for stdin)"""
+    loader, _, binary = FORMATS[get_format(path, fmt)]
+    if path == "-":
+        return loader(sys.stdin.buffer if binary else sys.stdin)
+    with open(path, "rb" if binary else "r") as placement_file:
+        return loader(placement_file)
+
+
+def save_placement(placement, path, fmt=None):
+    """Saves a placement file ('-' for stdout)"""
+    _, dumper, binary = FORMATS[get_format(path, fmt)]
+    if path == "-":
+        dumper(placement, sys.stdout.buffer if binary else sys.stdout)
+        return
+    with open(path, "wb" if binary else "w") as placement_file:
+        dumper(placement, placement_file)
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Phase timers, counters and peak memory shared by the CLI tools"""
+
+import sys
+import json
+import time
+import contextlib
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def get_peak_rss_kb():
+    """Returns the peak resident set size of the process (in KiB), or None
+    if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes
+        peak //= 1024
+    return peak
+
+
+class Profile():
+    """Phase timers and counters of a tool run"""
+
+    def __init__(self, tool):
+        """Just init the brand new instance"""
+        self.tool = tool
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as the given phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, duration):
+        """Adds some time to a phase"""
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def count(self, name, value=1):
+        """Increments a counter"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """Sets a counter"""
+        self.counters[name] = value
+
+    def as_dict(self):
+        """Returns the profile as a json friendly dict"""
+        return {"tool": self.tool,
+                "total": time.perf_counter() - self.start,
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+                "peak_rss_kb": get_peak_rss_kb()}
+
+    def dump(self, destination="-"):
+        """Writes the profile as json to a file ('-' for stderr)"""
+        dump_json(self.as_dict(), destination)
+
+
+def dump_json(data, destination="-"):
+    """Writes json data to a file ('-' for stderr, to keep stdout clean)"""
+    if destination == "-":
+        json.dump(data, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+        return
+    with open(destination, "w") as profile_file:
+        json.dump(data, profile_file, indent=2)
+
+
+def add_profile_argument(parser):
+    """Adds the common --profile option to an argparse parser"""
+    parser.add_argument("--profile", default=None, metavar="FILE",
+                        help="write phase timings, counters and peak memory "
+                             "as json to FILE ('-' for stderr)")
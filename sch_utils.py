@@ -3,11 +3,24 @@
 
 
 import os
-import math
+import heapq
+import bisect
+from collections import namedtuple
 from skidl import Part, Net, lib_search_paths, generate_netlist, ERC, KICAD
+from skidl import SchLib, LIBRARY, TEMPLATE
+from sym_index import SymbolIndex
 
 
 PACKAGES_LIB = {"0603": "0603_1608Metric_Pad1.05x0.95mm_HandSolder"}
+# Known packages: symbol/footprint pairs of the passive, LED and HE10
+# helpers, whose footprint is built from a package argument or hardcoded in
+# the function. The chip pairs come from the ICHelper subclasses (see
+# get_dop_pairs). Both are checked by crosscheck.py.
+DOP_KNOWN_PAIRS = [("R", "0603R"), ("R", "0805R"),
+                   ("C", "0603C"), ("C", "0805C"),
+                   ("L", "0603L"),
+                   ("LED", "0805LED"),
+                   ("HE10-12X2", "HE-10_2x12_2.54")]
 RSERIES = {3: [1.00, 2.20, 4.70],
            6: [1.00, 1.50, 2.20, 3.30, 4.70, 6.80],
           12: [1.00, 1.20, 1.50, 1.80, 2.20, 2.70, 3.30, 3.90, 4.70, 5.60,
@@ -52,35 +65,197 @@ RSERIES = {3: [1.00, 2.20, 4.70],
                9.76, 9.88]}
 
 
-def dop_part(symbol, module, fields=None, value=None):
-    """Returns a part from the Doppelganger library"""
+DOP_LIB = "Doppelganger.lib"
+_dop_index = None
+_dop_lib = None
+_dop_lib_symbols = set()
+_dop_prototypes = {}
+
+
+def find_dop_lib():
+    """Returns the path of the Doppelganger library, searched like skidl
+    does (then next to this file)"""
+    for path in list(lib_search_paths[KICAD]) + [os.path.dirname(__file__)]:
+        lib_path = os.path.join(os.path.expanduser(path), DOP_LIB)
+        if os.path.isfile(lib_path):
+            return lib_path
+    raise FileNotFoundError(DOP_LIB)
+
+
+def get_dop_lib():
+    """Returns the Doppelganger library, filled lazily: a symbol is parsed
+    (from its indexed DEF...ENDDEF block) only the first time it is used"""
+    global _dop_index, _dop_lib
+    if _dop_lib is None:
+        _dop_index = SymbolIndex.load(find_dop_lib())
+        _dop_lib = SchLib(tool=KICAD)
+        _dop_lib.filename = DOP_LIB
+    return _dop_lib
+
+
+def load_dop_symbol(symbol):
+    """Loads a single symbol into the Doppelganger library, if needed"""
+    lib = get_dop_lib()
+    if symbol in _dop_lib_symbols:
+        return lib
+    entry = _dop_index.get(symbol)
+    if entry is None:
+        raise ValueError(F"Unknown symbol {symbol} in {DOP_LIB}")
+    lib.add_parts(Part(part_defn=_dop_index.get_definition(symbol),
+                       tool=KICAD, dest=LIBRARY, filename=DOP_LIB,
+                       name=entry["name"], aliases=entry["aliases"],
+                       keywords="", datasheet="", description="",
+                       search_text="", tool_version="kicad"))
+    _dop_lib_symbols.update([entry["name"]] + entry["aliases"])
+    return lib
+
+
+def get_dop_prototype(symbol, module):
+    """Returns the template part of a symbol/footprint pair. It is built once,
+    parts are then cheap copies of it"""
+    key = (symbol, module)
+    prototype = _dop_prototypes.get(key)
+    if prototype is None:
+        prototype = Part(lib=load_dop_symbol(symbol), name=symbol,
+                         footprint=F"Doppelganger:{module}", dest=TEMPLATE)
+        _dop_prototypes[key] = prototype
+    return prototype
+
+
+def dop_part(symbol, module, fields=None, value=None, count=None):
+    """Returns a part from the Doppelganger library.
+    If count is given, returns a list of count identical parts instead."""
     if fields is None:
         fields = {}
-    p = Part(lib="Doppelganger.lib", name=symbol, value=value,
-             footprint=F"Doppelganger:{module}")
+    prototype = get_dop_prototype(symbol, module)
+    if count is None:
+        parts = [prototype.copy(value=value)]
+    else:
+        parts = prototype.copy(num_copies=count, value=value)
 
     # Merges the fields part
-    tmp = {**fields, **p.fields}
-    p.fields = tmp
-    return p
+    if fields:
+        for p in parts:
+            p.fields = {**fields, **p.fields}
+    if count is None:
+        return parts[0]
+    return parts
+
+
+# Decades covered by the precomputed series tables (1 mOhm to 9.88 GOhm)
+SERIES_DECADES = range(-3, 10)
+_series_tables = {}
+
+
+def get_serie_table(serie=12):
+    """Returns the sorted multi-decade table of the given series"""
+    table = _series_tables.get(serie)
+    if table is None:
+        # Rounded to 12 significant digits to get rid of float artifacts
+        table = sorted({float("%.12g" % (s * 10**d))
+                        for d in SERIES_DECADES for s in RSERIES[serie]})
+        _series_tables[serie] = table
+    return table
+
+
+def _nearest(table, r):
+    """Returns the nearest value of a sorted table (the above one on ties)"""
+    i = bisect.bisect_left(table, r)
+    if i == 0:
+        return table[0]
+    if i == len(table):
+        return table[-1]
+    above, below = table[i], table[i-1]
+    if above - r <= r - below:
+        return above
+    return below
 
 
 def get_res_from_std(r, serie=12):
     """Retreives the nearest value of the given resistor series"""
-    decade = 10**(int(math.log10(r)))
-    r_d = r/decade
-    above = decade*min(s for s in RSERIES[serie] if s >= r_d)
-    below = decade*max(s for s in RSERIES[serie] if s <= r_d)
-    if (above-r)/r <= (r-below)/r:
-        return above
-    return below
+    return _nearest(get_serie_table(serie), r)
+
+
+def get_res_from_std_batch(values, serie=12):
+    """Retreives the nearest values of the given resistor series for a whole
+    sequence of ideal values"""
+    table = get_serie_table(serie)
+    return [_nearest(table, r) for r in values]
+
+
+# Decades searched by the ratio solver (100 Ohm to 1 MOhm)
+RATIO_DECADES = range(2, 6)
+RatioSolution = namedtuple("RatioSolution", ["top", "bottom", "ratio",
+                                             "error"])
+
+
+def _get_legs(serie, decades, triples=False):
+    """Returns the sorted (value, resistors) legs available in the series:
+    single resistors and, with triples, two resistors in serie. Each value
+    is only listed once, with the fewest resistors."""
+    values = [v for v in get_serie_table(serie)
+              if 10**decades.start <= v < 10**decades.stop]
+    legs = [(v, (v,)) for v in values]
+    if triples:
+        legs += [(float("%.12g" % (a + b)), (a, b))
+                 for i, a in enumerate(values) for b in values[i:]]
+        legs.sort(key=lambda leg: (leg[0], len(leg[1])))
+        legs = [leg for i, leg in enumerate(legs)
+                if i == 0 or leg[0] != legs[i - 1][0]]
+    return values, legs
+
+
+def solve_ratio(ratio, serie=12, top_n=5, total=None, triples=False,
+                decades=RATIO_DECADES):
+    """Finds the resistor pairs of the given series whose top/bottom ratio
+    is the nearest of ratio. With triples, the top leg may be made of two
+    resistors in serie. If total is given, the relative error on the total
+    resistance is added to the ratio error.
+    Returns the top_n best RatioSolution (top is a tuple of resistors),
+    best first. A ratio is only listed once, with its best pair."""
+    bottoms, tops = _get_legs(serie, decades, triples)
+    top_values = [value for value, _ in tops]
+    best = {}
+    j = 0
+    # Two pointers: the target top value grows with the bottom value
+    for bottom in bottoms:
+        target = ratio * bottom
+        while j < len(top_values) and top_values[j] < target:
+            j += 1
+        # For a bottom, the error is convex in the top value: its top_n best
+        # tops are the top_n nearest of the ratio target or of the total
+        # target on each side
+        starts = [j]
+        if total is not None:
+            starts.append(bisect.bisect_left(top_values, total - bottom))
+        indexes = {k for start in starts
+                   for k in range(start - top_n, start + top_n)}
+        for k in indexes:
+            if not 0 <= k < len(tops):
+                continue
+            top_value, top = tops[k]
+            error = abs(top_value / bottom - ratio) / ratio
+            if total is not None:
+                error += abs(top_value + bottom - total) / total
+            solution = RatioSolution(top, bottom, top_value / bottom, error)
+            key = float("%.12g" % solution.ratio)
+            if key not in best or error < best[key].error:
+                best[key] = solution
+    return heapq.nsmallest(top_n, best.values(), key=lambda s: s.error)
+
+
+def solve_divider(vin, vout, serie=12, top_n=5, total=None, triples=False,
+                  decades=RATIO_DECADES):
+    """Finds the best voltage dividers from vin to vout (see solve_ratio)"""
+    return solve_ratio(float(vin) / vout - 1, serie, top_n, total, triples,
+                       decades)
 
 
 # Resistor, Capacitor & Inductor Basics
 
 def get_res(value, package, use_dedicated_value_field=True,
-            fields=None):
-    """Returns a resistor with default package"""
+            fields=None, count=None):
+    """Returns a resistor with default package (or a list of count ones)"""
     if fields is None:
         fields = {}
     fields["value"] = str(value)
@@ -88,12 +263,13 @@ def get_res(value, package, use_dedicated_value_field=True,
         dvf = str(value)
     else:
         dvf = None
-    return dop_part("R", package+"R", value=dvf, fields=fields)
+    return dop_part("R", package+"R", value=dvf, fields=fields,
+                    count=count)
 
 
 def get_capa(value, package, use_dedicated_value_field=True,
-             fields=None):
-    """Returns a capacitor with default package"""
+             fields=None, count=None):
+    """Returns a capacitor with default package (or a list of count ones)"""
     if fields is None:
         fields = {}
     package_str = package + "C"
@@ -102,11 +278,13 @@ def get_capa(value, package, use_dedicated_value_field=True,
         dvf = str(value)
     else:
         dvf = None
-    return dop_part("C", package+"C", value=dvf, fields=fields)
+    return dop_part("C", package+"C", value=dvf, fields=fields,
+                    count=count)
 
 def get_inductance(value, package, use_dedicated_value_field=True,
-                   fields=None):
-    """Returns an inductance with default package"""
+                   fields=None, count=None):
+    """Returns an inductance with default package (or a list of count
+    ones)"""
     if fields is None:
         fields = {}
     package_str = package + "L"
@@ -115,7 +293,8 @@ def get_inductance(value, package, use_dedicated_value_field=True,
         dvf = str(value)
     else:
         dvf = None
-    return dop_part("L", package+"L", value=dvf, fields=fields)
+    return dop_part("L", package+"L", value=dvf, fields=fields,
+                    count=count)
 
 def pull_updown(power, signals, value, package="0603", fields=None):
     """Insert a PullUp or PullDown on the given signal"""
@@ -123,13 +302,27 @@ def pull_updown(power, signals, value, package="0603", fields=None):
         fields = {}
     if not isinstance(signals, list):
         signals = [signals]
-    for signal in signals:
-        r = get_res(value, package, fields=fields)
+    resistors = get_res(value, package, fields=fields, count=len(signals))
+    for signal, r in zip(signals, resistors):
         power & r & signal
 
 
-def bypass_cap(net1, net2, values, package="0603", fields=None, descr=None):
-    """Adds one or more bypass capacitors"""
+def divider(high, mid, low, vin, vout, package="0603", serie=12,
+            total=None, triples=False, fields=None):
+    """Inserts the best voltage divider (see solve_divider) between nets:
+    high --> top resistor(s) --> mid --> bottom resistor --> low
+    Returns the RatioSolution used"""
+    solution = solve_divider(vin, vout, serie, 1, total, triples)[0]
+    chain = high
+    for value in solution.top:
+        chain = chain & get_res(value, package, fields=fields)
+    chain & mid & get_res(solution.bottom, package, fields=fields) & low
+    return solution
+
+
+def bypass_cap(net1, net2, values, package="0603", fields=None, descr=None,
+               count=1):
+    """Adds one or more bypass capacitors (count times each)"""
     if fields is None:
         fields = {}
     if not isinstance(values, list):
@@ -137,9 +330,9 @@ def bypass_cap(net1, net2, values, package="0603", fields=None, descr=None):
     if descr is not None:
         fields["bypass_dscr"] = descr
     for v in values:
-        c = get_capa(v, package, fields=fields)
-        net1 += c[1]
-        net2 += c[2]
+        for c in get_capa(v, package, fields=fields, count=count):
+            net1 += c[1]
+            net2 += c[2]
 
 
 def power_indicator(nets, voltage=5, res_pkg="0603", color="green",
@@ -163,11 +356,20 @@ class ICHelper():
     """Just an abstract class to simplify ic helper"""
 
     NAME = "UNKNOWN"
+    SYMBOL = None
+    MODULE = None
+    FIELDS = {}
+    CELL_COUNT = 0
+    MAPPING = []
 
-    def __init__(self, vcc, gnd, bypass_capacitor, c_fields=None):
+    def __init__(self, vcc, gnd, bypass_capacitor, c_fields=None, part=None):
         """Init the brand new instance
         If bypass is not None, bypass_cap must be a tuple as follows:
-        (value, package)"""
+        (value, package)
+        If part is None, a new chip is instantiated"""
+        if part is None:
+            part = self.new_part()
+        self.part = part
         self.vcc, self.gnd = vcc, gnd
         self.part["Vcc"] += vcc
         self.part["GND"] += gnd
@@ -182,6 +384,30 @@ class ICHelper():
         self.used_index = [False] * self.CELL_COUNT
         self.auto_inc_current = 0
 
+    @classmethod
+    def new_part(cls, count=None):
+        """Instantiates the chip (or a list of count chips)"""
+        return dop_part(cls.SYMBOL, cls.MODULE, fields=dict(cls.FIELDS),
+                        count=count)
+
+    @classmethod
+    def create_many(cls, count, vcc, gnd, bypass_capacitor=None,
+                    c_fields=None):
+        """Returns count helpers. The chips and their bypass capacitors are
+        instantiated in one pass"""
+        if c_fields is None:
+            c_fields = {}
+        chips = [cls(vcc, gnd, None, part=part)
+                 for part in cls.new_part(count)]
+        if bypass_capacitor is not None:
+            bypass_cap(vcc, gnd, *bypass_capacitor, fields=c_fields,
+                       descr=cls.NAME, count=count)
+        return chips
+
+    def free_count(self):
+        """Returns the number of gates left for autoincrement"""
+        return self.CELL_COUNT - self.auto_inc_current
+
     def get_next_index(self, req_index):
         """If index is None Returns the next index in the chip"""
         if req_index is None:
@@ -199,18 +425,19 @@ class LVC32(ICHelper):
     CELL_COUNT = 4
     MAPPING = [(1, 2, 3), (4, 5, 6), (9, 10, 8), (12, 13, 11)]
     NAME = "LVC32"
-
-    def __init__(self, vcc, gnd, bypass_cap=None, c_fields=None):
+    SYMBOL = "74LVC32"
+    MODULE = "TSSOP14"
+    FIELDS = {"Reference": "74LVC32APW,118",
+              "Descr": "Quad 2-input OR",
+              "CC": "2438891",
+              "JLCC": "C6087",
+              "JLROT": "270"}
+
+    def __init__(self, vcc, gnd, bypass_cap=None, c_fields=None, part=None):
         """Init the brand new instance."""
         if c_fields is None:
             c_fields = {}
-        self.part = dop_part("74LVC32", "TSSOP14",
-                         fields={"Reference": "74LVC32APW,118",
-                                 "Descr": "Quad 2-input OR",
-                                 "CC": "2438891",
-                                 "JLCC": "C6087",
-                                 "JLROT": "270"})
-        super().__init__(vcc, gnd, bypass_cap, c_fields=c_fields)
+        super().__init__(vcc, gnd, bypass_cap, c_fields=c_fields, part=part)
 
     def add(self, in1, in2, out=None, index=None):
         """Sets one of the xor cell. If index is None, autoincrement is used"""
@@ -240,46 +467,46 @@ class LVC07(ICHelper):
     """LVC07 helper"""
 
     CELL_COUNT = 6
+    MAPPING = [(F"A{i}", F"O{i}") for i in range(CELL_COUNT)]
     NAME = "LVC07"
-
-    def __init__(self, vcc, gnd, bypass_cap=None, c_fields=None):
+    SYMBOL = "74LVC07"
+    MODULE = "TSSOP14"
+    FIELDS = {"Reference": "74LVC07APW,118",
+              "Descr": "Hex Open Collector buffer",
+              "CC": "2438795",
+              "JLCC": "C6051",
+              "JLROT": "270"}
+
+    def __init__(self, vcc, gnd, bypass_cap=None, c_fields=None, part=None):
         """Init the brand new instance.
         If bypass is not None, bypass_cap must be a tuple as follows:
         (value, package)"""
         if c_fields is None:
             c_fields = {}
-        self.part = dop_part("74LVC07", "TSSOP14",
-                             fields={"Reference": "74LVC07APW,118",
-                                     "Descr": "Hex Open Collector buffer",
-                                     "CC": "2438795",
-                                     "JLCC": "C6051",
-                                     "JLROT": "270"})
-        super().__init__(vcc, gnd, bypass_cap, c_fields=c_fields)
+        super().__init__(vcc, gnd, bypass_cap, c_fields=c_fields, part=part)
 
     def add(self, inp, out=None, index=None):
         """Sets one of the open collector buffer."""
         index = self.get_next_index(index)
         self.used_index[index] = True
-        try:
-            self.part[F"A{index}"] += inp
-        except:
-            print("Oups: index = {0}".format(index))
-            assert False
+        m = self.MAPPING[index]
+        self.part[m[0]] += inp
 
         if out is None:
             out = Net("Buff_OC_{0}".format(inp.name))
-        self.part[F"O{index}"] += out
+        self.part[m[1]] += out
         return out
 
     def fill_unused(self, net=None):
         """Sets GND on unused inputs and NC on used outputs"""
         for i in range(self.CELL_COUNT):
             if not self.used_index[i]:
+                m = self.MAPPING[i]
                 if net is None:
-                    self.part[F"A{i}"] += self.gnd
+                    self.part[m[0]] += self.gnd
                 else:
-                    self.part[F"A{i}"] += net
-                self.part[F"O{i}"] += NC
+                    self.part[m[0]] += net
+                self.part[m[1]] += NC
 
 
 # HC07 Helper
@@ -287,47 +514,57 @@ class HC4066(ICHelper):
     """HC4066 helper"""
 
     CELL_COUNT = 4
+    MAPPING = [(F"{i}E", F"{i}Y", F"{i}Z") for i in range(1, CELL_COUNT+1)]
     NAME = "HC4066"
-
-    def __init__(self, vcc, gnd, bypass_cap=None, c_fields=None):
+    SYMBOL = "74HC4066"
+    MODULE = "TSSOP14"
+    FIELDS = {"Ref": "74HC4066PW,118",
+              "Descr": "Quad bilateral switches ",
+              "CC": "2463675",
+              "JLCC": "C5350",
+              "JLROT": "270"}
+
+    def __init__(self, vcc, gnd, bypass_cap=None, c_fields=None, part=None):
         """Init the brand new instance.
         If bypass is not None, bypass_cap must be a tuple as follows:
         (value, package)"""
         if c_fields is None:
             c_fields = {}
-        self.part = dop_part("74HC4066", "TSSOP14",
-                             fields={"Ref": "74HC4066PW,118",
-                                     "Descr": "Quad bilateral switches ",
-                                     "CC": "2463675",
-                                     "JLCC": "C5350",
-                                     "JLROT": "270"})
-        super().__init__(vcc, gnd, bypass_cap, c_fields=c_fields)
+        super().__init__(vcc, gnd, bypass_cap, c_fields=c_fields, part=part)
 
     def add(self, e, y, z, index=None):
         """Sets one of the open collector buffer."""
         index = self.get_next_index(index)
         self.used_index[index] = True
-        real_index = index + 1
-        try:
-            self.part[F"{real_index}E"] += e
-        except:
-            print(F"Oups: index = {real_index}")
-            assert False
-
-        self.part[F"{real_index}Y"] += y
-        self.part[F"{real_index}Z"] += z
+        m = self.MAPPING[index]
+        self.part[m[0]] += e
+        self.part[m[1]] += y
+        self.part[m[2]] += z
 
     def fill_unused(self, net=None):
         """Sets GND on unused inputs and NC on used outputs"""
         for i in range(self.CELL_COUNT):
             if not self.used_index[i]:
-                real_index = i + 1
+                m = self.MAPPING[i]
                 if net is None:
-                    self.part[F"{real_index}E"] += self.gnd
+                    self.part[m[0]] += self.gnd
                 else:
-                    self.part[F"{real_index}E"] += net
-                self.part[F"{real_index}Y"] += NC
-                self.part[F"{real_index}Z"] += NC
+                    self.part[m[0]] += net
+                self.part[m[1]] += NC
+                self.part[m[2]] += NC
+
+
+def get_dop_pairs():
+    """Returns all the symbol/footprint pairs used by the helpers: the known
+    packages and the chips of the ICHelper subclasses"""
+    pairs = list(DOP_KNOWN_PAIRS)
+    todo = list(ICHelper.__subclasses__())
+    while todo:
+        chip_class = todo.pop(0)
+        todo += chip_class.__subclasses__()
+        if chip_class.SYMBOL is not None:
+            pairs.append((chip_class.SYMBOL, chip_class.MODULE))
+    return pairs
 
 
 class ICSpan():
@@ -366,9 +603,113 @@ class ICSpan():
             self.add_chip()
             return self.current_part.add(*args, **kwargs)
 
+    def add_many(self, gates, fill_unused=True):
+        """Adds a list of gates at once. Each gate is the tuple of the add
+        arguments of the chip class (or a single net for one input gates).
+        The missing chips are instantiated up front, then the gates are
+        wired in order and, if fill_unused, the unused gates of the last
+        chip are filled. Returns the list of the add results."""
+        gates = list(gates)
+        cell_count = self.chip_class.CELL_COUNT
+        missing = len(gates) - self.current_part.free_count()
+        if missing > 0:
+            chips = self.chip_class.create_many(-(-missing // cell_count),
+                                                self.vcc, self.gnd,
+                                                self.bypass_capacitor)
+            slots = [(self.current_part, i)
+                     for i in range(self.current_part.auto_inc_current,
+                                    cell_count)]
+            slots += [(chip, i) for chip in chips for i in range(cell_count)]
+            self.parts += chips
+            self.current_part = chips[-1]
+        else:
+            start = self.current_part.auto_inc_current
+            slots = [(self.current_part, i)
+                     for i in range(start, start + len(gates))]
+
+        results = []
+        for gate, (chip, index) in zip(gates, slots):
+            if not isinstance(gate, tuple):
+                gate = (gate,)
+            results.append(chip.add(*gate, index=index))
+            chip.auto_inc_current = index + 1
+        if fill_unused:
+            self.fill_unused()
+        return results
+
     def fill_unused(self):
-        """Fills the unused gates of the last chip"""
-        self.current_part.fill_unused()
+        """Fills the unused gates of the last chip. It is then exhausted, so
+        a later gate goes to a new chip instead of a grounded one"""
+        part = self.current_part
+        part.fill_unused()
+        part.used_index = [True] * part.CELL_COUNT
+        part.auto_inc_current = part.CELL_COUNT
+
+
+class GatePacker():
+    """Collects gate requests for any multi gate chip class and packs them
+    on the fewest chips. Requests are grouped by (chip class, vcc, gnd) and,
+    if hint_field is given, by placement hint too: the chips of a hinted
+    group get the hint in their hint_field field."""
+    def __init__(self, bypass_cap=None, c_fields=None, hint_field=None):
+        """Init the brand new instance"""
+        self.bypass_capacitor = bypass_cap
+        self.c_fields = c_fields
+        self.hint_field = hint_field
+        self.requests = []
+        self.groups = {}
+        self.chips = {}
+
+    def request(self, chip_class, vcc, gnd, *args, hint=None, **kwargs):
+        """Records a gate, args and kwargs are the ones of chip_class.add
+        (without index). Returns the position of the request: the add
+        result is at this position in the pack() result"""
+        if self.hint_field is None:
+            hint = None
+        key = (chip_class, vcc, gnd, hint)
+        self.groups.setdefault(key, []).append(len(self.requests))
+        self.requests.append((args, kwargs))
+        return len(self.requests) - 1
+
+    def get_constructor(self, chip_class, vcc, gnd, hint=None):
+        """Return a function that records a gate of the given chip class"""
+
+        def constructor(*args, **kargs):
+            """Just a pseudo static function"""
+            return self.request(chip_class, vcc, gnd, *args, hint=hint,
+                                **kargs)
+
+        return constructor
+
+    def pack(self, fill_unused=True):
+        """Instantiates the chips and wires all the recorded gates through
+        the add method of their chip class. Returns the add results, in
+        request order"""
+        results = [None] * len(self.requests)
+        self.chips = {}
+        for key, positions in self.groups.items():
+            chip_class, vcc, gnd, hint = key
+            cell_count = chip_class.CELL_COUNT
+            chips = chip_class.create_many(-(-len(positions) // cell_count),
+                                           vcc, gnd, self.bypass_capacitor,
+                                           c_fields=self.c_fields)
+            if hint is not None:
+                for chip in chips:
+                    chip.part.fields[self.hint_field] = str(hint)
+            for i, position in enumerate(positions):
+                args, kwargs = self.requests[position]
+                chip = chips[i // cell_count]
+                results[position] = chip.add(*args, index=i % cell_count,
+                                             **kwargs)
+            if fill_unused:
+                chips[-1].fill_unused()
+            self.chips[key] = chips
+        self.requests, self.groups = [], {}
+        return results
+
+    def chip_count(self):
+        """Returns the number of chips instantiated by the last pack"""
+        return sum(len(chips) for chips in self.chips.values())
 
 
 def unit_map_on_he10(sigs):
@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Streaming s-expression tokenizer for KiCad files"""
+
+import re
+
+
+CHUNK_SIZE = 1 << 16
+
+# Quoted strings and xml tags may be left open at the end of a chunk
+_SEXPR_TOKEN = r'\(|\)|"(?:[^"\\]|\\.)*"?|[^\s()"]+'
+_XML_TOKEN = r'\(|\)|"(?:[^"\\]|\\.)*"?|<[^>]*>?|[^\s()<>"]+'
+TOKEN_RE = re.compile(_SEXPR_TOKEN)
+XML_TOKEN_RE = re.compile(_XML_TOKEN)
+CLOSED_QUOTED_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def iter_tokens(stream, xml=False, chunk_size=CHUNK_SIZE):
+    """Yields the tokens of a text stream, read chunk by chunk.
+    Quoted strings are yielded with their quotes. If xml is True, xml tags
+    are yielded as single tokens too."""
+    token_re = XML_TOKEN_RE if xml else TOKEN_RE
+    pending = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        buf = pending + chunk
+        pending = ""
+        for match in token_re.finditer(buf):
+            token = match.group()
+            # The last token may continue in the next chunk, and so may a
+            # quoted string cut on an escape (the rest of the buffer)
+            if chunk and (match.end() == len(buf) or
+                          (token[0] == '"' and
+                           not CLOSED_QUOTED_RE.fullmatch(token))):
+                pending = buf[match.start():]
+                break
+            yield token
+        if not chunk:
+            return
+
+
+def unquote(token):
+    """Removes the quotes (and escapes) of a quoted token"""
+    if len(token) > 1 and token[0] == '"' and token[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+    return token
+
+
+def iter_nodes(stream, heads=None, chunk_size=CHUNK_SIZE, strict=False):
+    """Yields the parsed nodes (nested lists of unquoted atoms) of a stream.
+    If heads is given, only the nodes whose first atom is in heads are
+    yielded (at any depth, without their enclosing nodes being built).
+    Otherwise the top level nodes are yielded.
+    If strict is True, unbalanced parenthesis raise a ValueError."""
+    stack = []
+    for token in iter_tokens(stream, chunk_size=chunk_size):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            if not stack:
+                if strict:
+                    raise ValueError("Unexpected ')'")
+                continue
+            node = stack.pop()
+            if heads is None:
+                if stack:
+                    stack[-1].append(node)
+                else:
+                    yield node
+            elif node and node[0] in heads:
+                yield node
+            elif any(parent and parent[0] in heads for parent in stack):
+                # Child (at any depth) of a wanted node
+                stack[-1].append(node)
+        elif stack:
+            stack[-1].append(unquote(token))
+    if strict and stack:
+        raise ValueError("{0} unclosed '('".format(len(stack)))
+
+
+def load(stream, strict=False):
+    """Parses a whole s-expression stream. Returns its first node"""
+    nodes = iter_nodes(stream, strict=strict)
+    first = next(nodes, None)
+    if strict:
+        # Consume the stream up to the end to check it
+        for _ in nodes:
+            pass
+    return first
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Symbol index of a legacy KiCad (.lib) schematic library.
+The byte offsets of each DEF...ENDDEF block are recorded (with the pins and
+unit count of the symbol) so a single symbol can be read back from the
+mmapped library without parsing the whole file."""
+
+import os
+import mmap
+import json
+import argparse
+
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".sym_index.json"
+
+
+def get_index_path(lib_path):
+    """Returns the default index path of a library"""
+    lib_dir, lib_name = os.path.split(lib_path)
+    return os.path.join(lib_dir, "." + lib_name + INDEX_SUFFIX)
+
+
+def scan_library(data):
+    """Scans the content (bytes or mmap) of a library.
+    Returns {symbol name: entry}. Aliases get their own (shared) entry."""
+    symbols = {}
+    entry = None
+    offset = 0
+    size = len(data)
+    while offset < size:
+        end = data.find(b"\n", offset)
+        end = size if end < 0 else end + 1
+        line = data[offset:end]
+        if line.startswith(b"DEF "):
+            fields = line.split()
+            entry = {"offset": offset,
+                     "name": fields[1].decode().lstrip("~"),
+                     "ref": fields[2].decode(),
+                     "units": int(fields[7]) if len(fields) > 7 else 1,
+                     "aliases": [],
+                     "pins": []}
+        elif entry is not None:
+            if line.startswith(b"X "):
+                fields = line.split()
+                # X name number posx posy length orient Snum Snom unit ...
+                unit = int(fields[9]) if len(fields) > 9 else 0
+                entry["pins"].append([fields[2].decode(), fields[1].decode(),
+                                      unit])
+            elif line.startswith(b"ALIAS"):
+                entry["aliases"] = [alias.decode()
+                                    for alias in line.split()[1:]]
+            elif line.startswith(b"ENDDEF"):
+                entry["length"] = end - entry["offset"]
+                symbols[entry["name"]] = entry
+                for alias in entry["aliases"]:
+                    symbols.setdefault(alias, entry)
+                entry = None
+        offset = end
+    return symbols
+
+
+class SymbolIndex():
+    """Index of a legacy schematic library, reading symbols through mmap"""
+
+    def __init__(self, lib_path, symbols, mtime, size):
+        """Just init the brand new instance"""
+        self.lib_path = lib_path
+        self.symbols = symbols
+        self.mtime = mtime
+        self.size = size
+        self._lib_file = None
+        self._map = None
+
+    def __contains__(self, name):
+        return name in self.symbols
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def get(self, name):
+        """Returns the index entry of a symbol (None if unknown)"""
+        return self.symbols.get(name)
+
+    def pin_numbers(self, name):
+        """Returns the set of the pin numbers of a symbol"""
+        return {pin[0] for pin in self.symbols[name]["pins"]}
+
+    def get_definition(self, name):
+        """Returns the DEF...ENDDEF lines of a symbol, read from the mmapped
+        library"""
+        entry = self.symbols[name]
+        if self._map is None:
+            self._lib_file = open(self.lib_path, "rb")
+            self._map = mmap.mmap(self._lib_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        block = self._map[entry["offset"]:entry["offset"] + entry["length"]]
+        return block.decode("utf-8").splitlines(True)
+
+    def close(self):
+        """Releases the mmapped library"""
+        if self._map is not None:
+            self._map.close()
+            self._lib_file.close()
+            self._map = self._lib_file = None
+
+    def save(self, path=None):
+        """Saves the (compact) index"""
+        if path is None:
+            path = get_index_path(self.lib_path)
+        with open(path, "w") as index_file:
+            json.dump({"version": INDEX_VERSION, "mtime": self.mtime,
+                       "size": self.size, "symbols": self.symbols},
+                      index_file, separators=(",", ":"))
+
+    @classmethod
+    def build(cls, lib_path):
+        """Indexes a library"""
+        stat = os.stat(lib_path)
+        with open(lib_path, "rb") as lib_file:
+            if stat.st_size == 0:
+                symbols = {}
+            else:
+                with mmap.mmap(lib_file.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    symbols = scan_library(data)
+        return cls(lib_path, symbols, stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def load(cls, lib_path, index_path=None):
+        """Loads the index of a library, rebuilding it (and saving it back,
+        if possible) when the library changed"""
+        if index_path is None:
+            index_path = get_index_path(lib_path)
+        stat = os.stat(lib_path)
+        try:
+            with open(index_path) as index_file:
+                data = json.load(index_file)
+            if data.get("version") == INDEX_VERSION and \
+                    data["mtime"] == stat.st_mtime_ns and \
+                    data["size"] == stat.st_size:
+                return cls(lib_path, data["symbols"], data["mtime"],
+                           data["size"])
+        except (IOError, ValueError, KeyError):
+            pass
+        index = cls.build(lib_path)
+        try:
+            index.save(index_path)
+        except (IOError, OSError):
+            pass
+        return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Schematic library indexer")
+    parser.add_argument("-o", default=None,
+                        help="index file (default: .<library>" + INDEX_SUFFIX
+                             + " next to the library)")
+    parser.add_argument("library", help="legacy .lib file")
+    args = parser.parse_args()
+
+    lib_index = SymbolIndex.load(args.library, args.o)
+    print("{0}: {1} symbols".format(args.library, len(lib_index)))
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+"""The tools are top level modules of the repository"""
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import pytest
+
+from keyboard_placement import MX_CENTER, IU_PER_MM, generate_placement
+
+
+def get_stem(params):
+    """Returns where KiCad puts the MX stem of a placed switch (mm): the
+    footprint point is mirrored around the x axis if flipped, then rotated
+    with the footprint"""
+    x, y = MX_CENTER
+    if params["flipped"]:
+        y = -y
+    angle = math.radians(params["orientation"] / 10)
+    pos_x, pos_y = (value / IU_PER_MM for value in params["position"])
+    return (pos_x + x * math.cos(angle) + y * math.sin(angle),
+            pos_y - x * math.sin(angle) + y * math.cos(angle))
+
+
+@pytest.mark.parametrize("switch", [{}, {"rotation": 180}, {"rotation": 90},
+                                    {"flipped": True},
+                                    {"rotation": 180, "flipped": True}])
+@pytest.mark.parametrize("key", [1, {"w": 1, "r": 30}])
+def test_stem_on_key_center(switch, key):
+    placement = dict(generate_placement({"unit": 19.05, "switch": switch,
+                                         "rows": [[key]]}))
+    stem = get_stem(placement["SW1"])
+    assert stem == pytest.approx((9.525, 9.525), abs=1e-5)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import pytest
+
+import sexpr
+
+
+SEXPR = ('(export (version D)\n'
+         '  (comp (ref R1) (value "x\\"y z")\n'
+         '    (field (name Descr) "a \\\\ b \\"(c)\\"") (field (name F1) 10K))'
+         '\n  (lib "C:\\\\Program Files\\\\kicad"))\n')
+XML = ('<export version="D"><comp ref="R1">\n'
+       '<field name="Descr">Resistor (see "note\\" here")</field>\n'
+       '<fields>(field (name JLCC) "C\\"1")</fields></comp></export>\n')
+
+
+def tokenize(text, xml=False, chunk_size=sexpr.CHUNK_SIZE):
+    return list(sexpr.iter_tokens(io.StringIO(text), xml, chunk_size))
+
+
+@pytest.mark.parametrize("text, xml", [(SEXPR, False), (XML, True)])
+def test_tokens_do_not_depend_on_chunk_size(text, xml):
+    expected = tokenize(text, xml, len(text) + 1)
+    for chunk_size in range(1, len(text) + 1):
+        assert tokenize(text, xml, chunk_size) == expected, chunk_size
+
+
+def test_escaped_quote_on_chunk_boundary():
+    for chunk_size in range(1, 10):
+        assert tokenize('(a "x\\"y z")', chunk_size=chunk_size) == \
+            ["(", "a", '"x\\"y z"', ")"]